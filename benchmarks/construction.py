@@ -0,0 +1,60 @@
+"""
+Measure how long it takes to build nodes, and to attach many children to a
+node.
+
+Usage: python benchmarks/construction.py [width ...]
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from navutils import menu  # NOQA
+
+
+def build_children(width):
+    return [
+        menu.Node('c{0}'.format(i), 'Child {0}'.format(i), url='#', weight=i % 7)
+        for i in range(width)
+    ]
+
+
+def with_constructor(children):
+    menu.Node('parent', 'Parent', url='#', children=children)
+
+
+def with_add(children):
+    parent = menu.Node('parent', 'Parent', url='#')
+    for child in children:
+        parent.add(child)
+
+
+def with_resort(children):
+    # what Node.add used to do: sort all the children after each insertion
+    parent = menu.Node('parent', 'Parent', url='#')
+    for child in children:
+        child.parent = parent
+        parent._children.append(child)
+        parent._children = sorted(parent._children, key=lambda i: i.weight, reverse=True)
+
+
+def main(widths):
+    print('{0:>8} {1:>14} {2:>14} {3:>14} {4:>14}'.format(
+        'width', 'build nodes', 'constructor', 'add', 'resort (old)'))
+    for width in widths:
+        children = build_children(width)
+        number = max(1, 20000 // width)
+        timings = [
+            # building the children themselves, then attaching them
+            min(timeit.repeat(lambda: build_children(width), number=number, repeat=3)) / number
+        ] + [
+            min(timeit.repeat(lambda: func(children), number=number, repeat=3)) / number
+            for func in (with_constructor, with_add, with_resort)
+        ]
+        print('{0:>8} {1:>12.3f}ms {2:>12.3f}ms {3:>12.3f}ms {4:>12.3f}ms'.format(
+            width, *[t * 1000 for t in timings]))
+
+
+if __name__ == '__main__':
+    main([int(arg) for arg in sys.argv[1:]] or [10, 100, 1000, 5000])
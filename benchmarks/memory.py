@@ -0,0 +1,65 @@
+"""
+Report the memory used by large menus, using tracemalloc.
+
+Nodes are compared with a replica of the previous, __dict__-based node
+layout, where each node held its own attrs / link_attrs / context dicts.
+
+Usage: python benchmarks/memory.py [count]
+"""
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from navutils import menu  # NOQA
+
+
+class DictNode(object):
+    """The attributes the node used to store in its __dict__"""
+    def __init__(self, id, label, url=None, attrs=None, link_attrs=None, context=None, **kwargs):
+        self._id = id
+        self.parent = None
+        self.pattern_name = None
+        self.url = url
+        self.is_divider = False
+        self.label = label
+        self.weight = 0
+        self.template = 'navutils/node.html'
+        self.css_class = None
+        self.reverse_kwargs = []
+        self.link_attrs = {} if link_attrs is None else link_attrs
+        self.attrs = {} if attrs is None else attrs
+        self.context = {} if context is None else context
+        self.kwargs = kwargs
+        self._children = []
+
+
+def measure(factory, count):
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    nodes = [factory('node{0}'.format(i), 'Label', url='/', attrs={}, link_attrs={}, context={})
+             for i in range(count)]
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    size = sum(stat.size_diff for stat in after.compare_to(before, 'filename'))
+    del nodes
+    return size
+
+
+def main(count):
+    results = [
+        ('dict-based node', measure(DictNode, count)),
+        ('Node', measure(menu.Node, count)),
+        ('PermissionNode', measure(
+            lambda *args, **kwargs: menu.PermissionNode(*args, permission='app.perm', **kwargs), count)),
+    ]
+    reference = results[0][1]
+    print('{0} nodes'.format(count))
+    for name, size in results:
+        print('{0:>16}: {1:>8.1f} KiB, {2:>6.1f} bytes/node ({3:+.0%})'.format(
+            name, size / 1024., float(size) / count, float(size - reference) / reference))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
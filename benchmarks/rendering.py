@@ -0,0 +1,278 @@
+"""
+Time menu and breadcrumb rendering on synthetic menus, for anonymous, staff
+and permissioned users.
+
+Menus are ``width`` nodes wide and ``depth`` levels deep. Node types are
+picked in turn from the mix, e.g. ``plain=2,permission=1`` builds two plain
+nodes for each PermissionNode. Available types: plain, permission, passtest
+and dynamic (a node with callable children).
+
+Usage:
+    python benchmarks/rendering.py [--width 5] [--depth 3] [--mix plain=4,permission=2,passtest=1,dynamic=1]
+    python benchmarks/rendering.py --output baseline.json
+    python benchmarks/rendering.py --compare baseline.json [--threshold 0.1]
+
+With ``--compare``, results slower than the baseline by more than the
+threshold are reported as regressions, and the script exits with status 1.
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import django  # NOQA
+from django.conf import settings  # NOQA
+
+NODE_TYPES = ('plain', 'permission', 'passtest', 'dynamic')
+USERS = ('anonymous', 'staff', 'permissioned')
+
+
+def setup_django():
+    settings.configure(
+        INSTALLED_APPS=[
+            'django.contrib.auth',
+            'django.contrib.contenttypes',
+            'navutils',
+            'tests.test_app',
+        ],
+        DATABASES={
+            'default': {
+                'ENGINE': 'django.db.backends.sqlite3',
+                'NAME': ':memory:',
+            }
+        },
+        ROOT_URLCONF='tests.test_app.urls',
+        TEMPLATES=[
+            {
+                'BACKEND': 'django.template.backends.django.DjangoTemplates',
+                'APP_DIRS': True,
+            },
+        ],
+        SECRET_KEY='not secure only for benchmarks',
+    )
+    django.setup()
+
+    from django.core.management import call_command
+    call_command('migrate', run_syncdb=True, verbosity=0)
+
+
+def parse_mix(value):
+    mix = []
+    for part in value.split(','):
+        name, _, count = part.partition('=')
+        if name not in NODE_TYPES:
+            raise argparse.ArgumentTypeError('unknown node type: {0}'.format(name))
+        mix += [name] * int(count or 1)
+    return mix
+
+
+def build_menu(width, depth, mix, native=False):
+    from navutils import menu
+
+    counter = [0]
+
+    def next_type():
+        node_type = mix[counter[0] % len(mix)]
+        counter[0] += 1
+        return node_type
+
+    def build_nodes(level, prefix):
+        nodes = []
+        for i in range(width):
+            node_id = '{0}{1}'.format(prefix, i)
+            kwargs = {
+                'url': '/{0}'.format(node_id),
+                'weight': i % 3,
+            }
+            node_type = next_type()
+            if level + 1 < depth:
+                if node_type == 'dynamic':
+                    kwargs['children'] = lambda level=level, node_id=node_id: build_nodes(level + 1, node_id + '-')
+                else:
+                    kwargs['children'] = build_nodes(level + 1, node_id + '-')
+
+            if node_type == 'permission':
+                node = menu.PermissionNode(node_id, 'Node {0}'.format(node_id), permission='test_app.foo', **kwargs)
+            elif node_type == 'passtest':
+                node = menu.PassTestNode(
+                    node_id, 'Node {0}'.format(node_id), test=lambda user, context: user.is_staff, **kwargs)
+            else:
+                node = menu.Node(node_id, 'Node {0}'.format(node_id), **kwargs)
+            nodes.append(node)
+        return nodes
+
+    main_menu = menu.Menu('main', native=native)
+    for node in build_nodes(0, 'n'):
+        main_menu.register(node)
+    return main_menu
+
+
+def count_nodes(nodes):
+    return sum(1 + count_nodes(node.children) for node in nodes)
+
+
+def get_users():
+    from django.contrib.auth import get_user_model
+    from django.contrib.auth.models import AnonymousUser, Permission
+
+    User = get_user_model()
+    staff = User.objects.create(username='staff', is_staff=True)
+    permissioned = User.objects.create(username='permissioned')
+    permissioned.user_permissions.add(
+        Permission.objects.get(content_type__app_label='test_app', codename='foo'))
+    # reload the user, to start without cached permissions
+    permissioned = User.objects.get(pk=permissioned.pk)
+    return {
+        'anonymous': AnonymousUser(),
+        'staff': staff,
+        'permissioned': permissioned,
+    }
+
+
+def get_benchmarks(options):
+    from django.test import RequestFactory
+    from django.views.generic.base import ContextMixin
+
+    from navutils import Breadcrumb, BreadcrumbsMixin
+    from navutils.templatetags import navutils_tags
+
+    mix = parse_mix(options.mix)
+    template_menu = build_menu(options.width, options.depth, mix)
+    native_menu = build_menu(options.width, options.depth, mix, native=True)
+    first_node = list(template_menu.values())[0]
+    crumbs = [
+        Breadcrumb('Crumb {0}'.format(i), pattern_name='index' if i % 2 else None, url=None if i % 2 else '/c')
+        for i in range(options.depth + 1)
+    ]
+
+    class View(BreadcrumbsMixin, ContextMixin):
+        title = 'Page'
+
+        def get_breadcrumbs(self):
+            return list(crumbs)
+
+    def render_breadcrumbs(user):
+        return lambda: navutils_tags.render_breadcrumbs({}, crumbs)
+
+    def get_context_data(user):
+        request = RequestFactory().get('/')
+        request.user = user
+
+        def run():
+            view = View()
+            view.request = request
+            return view.get_context_data()
+        return run
+
+    benchmarks = {
+        'render_menu': lambda user: lambda: navutils_tags.render_menu({}, menu=template_menu, user=user),
+        'render_menu[native]': lambda user: lambda: navutils_tags.render_menu({}, menu=native_menu, user=user),
+        'render_node': lambda user: lambda: navutils_tags.render_node({}, node=first_node, user=user),
+        'render_breadcrumbs': render_breadcrumbs,
+        'BreadcrumbsMixin.get_context_data': get_context_data,
+    }
+    return benchmarks, count_nodes(template_menu.values())
+
+
+def run(options):
+    benchmarks, node_count = get_benchmarks(options)
+    users = get_users()
+    results = {}
+    for benchmark, build in benchmarks.items():
+        for user_type in USERS:
+            func = build(users[user_type])
+            # warm up caches (templates, reversed URLs...)
+            func()
+            timings = [
+                timing / options.number
+                for timing in timeit.repeat(func, number=options.number, repeat=options.repeat)
+            ]
+            results['{0}:{1}'.format(benchmark, user_type)] = {
+                'best_us': min(timings) * 1e6,
+                'median_us': statistics.median(timings) * 1e6,
+            }
+    return {
+        'meta': {
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'width': options.width,
+            'depth': options.depth,
+            'mix': options.mix,
+            'nodes': node_count,
+        },
+        'results': results,
+    }
+
+
+def compare(report, baseline, threshold):
+    """
+    Print the results next to the baseline ones.
+
+    :return: the names of the benchmarks that got slower than ``threshold``
+    """
+    if report['meta'] != baseline['meta']:
+        print('Warning: the baseline was built with different parameters: {0}'.format(baseline['meta']))
+
+    regressions = []
+    print('{0:<50} {1:>12} {2:>12} {3:>8}'.format('benchmark', 'baseline', 'current', 'ratio'))
+    for name, result in sorted(report['results'].items()):
+        reference = baseline['results'].get(name)
+        if reference is None:
+            print('{0:<50} {1:>12} {2:>10.1f}us'.format(name, '-', result['best_us']))
+            continue
+        ratio = result['best_us'] / reference['best_us']
+        flag = ''
+        if ratio > 1 + threshold:
+            flag = 'REGRESSION'
+            regressions.append(name)
+        elif ratio < 1 - threshold:
+            flag = 'improvement'
+        print('{0:<50} {1:>10.1f}us {2:>10.1f}us {3:>8.2f} {4}'.format(
+            name, reference['best_us'], result['best_us'], ratio, flag))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark menu and breadcrumb rendering')
+    parser.add_argument('--width', type=int, default=5, help='number of children per node')
+    parser.add_argument('--depth', type=int, default=3, help='number of menu levels')
+    parser.add_argument('--mix', default='plain=4,permission=2,passtest=1,dynamic=1',
+                        help='node types, e.g. plain=4,permission=2,passtest=1,dynamic=1')
+    parser.add_argument('--number', type=int, default=20, help='calls per timing')
+    parser.add_argument('--repeat', type=int, default=5, help='number of timings')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--compare', help='compare the results with this JSON file')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='slowdown ratio reported as a regression when comparing, default to 0.1')
+    options = parser.parse_args(argv)
+    try:
+        parse_mix(options.mix)
+    except (argparse.ArgumentTypeError, ValueError) as e:
+        parser.error(str(e))
+
+    setup_django()
+    report = run(options)
+
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+    if options.compare:
+        with open(options.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, options.threshold)
+        if regressions:
+            print('{0} regression(s) over {1:.0%}'.format(len(regressions), options.threshold))
+            return 1
+    elif not options.output:
+        print(json.dumps(report, indent=2, sort_keys=True))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -21,6 +21,7 @@ def pytest_configure():
             'django.contrib.admin',
             'django.contrib.sessions',
             'navutils',
+            'navutils.db',
             'tests.test_app',
         ],
         MIDDLEWARE_CLASSES=(
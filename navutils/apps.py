@@ -5,5 +5,9 @@ class App(AppConfig):
     name = 'navutils'
 
     def ready(self):
-        from . import menu
-        menu.registry.autodiscover((a.name for a in apps.get_app_configs()))
+        from . import instrumentation, menu, settings
+        instrumentation.configure()
+        menu.registry.autodiscover(
+            (a.name for a in apps.get_app_configs()),
+            lazy=settings.NAVUTILS_MENU_CONFIG['LAZY_AUTODISCOVERY'],
+        )
@@ -1,13 +1,18 @@
-try:
-    # Django 1.10+
-    from django.urls import reverse
-except ImportError:
-    from django.core.urlresolvers import reverse
+from .cache import cached_reverse
 
 
 class Breadcrumb(object):
+    __slots__ = (
+        'pattern_name',
+        'url',
+        'label',
+        'css_class',
+        'reverse_kwargs',
+        '__weakref__',
+    )
+
     def __init__(self, label, pattern_name=None, url=None, title=None, css_class=None,
-                 reverse_kwargs=[], **kwargs):
+                 reverse_kwargs=(), **kwargs):
         if pattern_name and url:
             raise ValueError('Breadcrumb accepts either a url or a pattern_name arg, but not both')
         if not pattern_name and not url:
@@ -25,7 +30,7 @@ class Breadcrumb(object):
                 key: value for key, value in kwargs.items()
                 if key in self.reverse_kwargs
             }
-            return reverse(self.pattern_name, kwargs=expected_kwargs)
+            return cached_reverse(self.pattern_name, kwargs=expected_kwargs)
         return self.url
 
 
@@ -0,0 +1,311 @@
+from collections import OrderedDict
+import hashlib
+import threading
+import uuid
+import weakref
+
+from django.core.cache import caches
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils import translation
+
+from . import instrumentation
+from .state import get_children_getter, is_viewable
+
+try:
+    # Django 1.10+
+    from django.urls import get_script_prefix, get_urlconf, reverse
+except ImportError:
+    from django.core.urlresolvers import get_script_prefix, get_urlconf, reverse
+
+
+class LRUCache(object):
+    """
+    A small, thread-safe, bounded mapping that evicts the least recently
+    used entries once ``maxsize`` is reached. Keeps track of hits and misses
+    so the cache efficiency can be checked at runtime.
+    """
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def info(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+        }
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+
+class MenuFragmentCache(object):
+    """
+    Store rendered menus in a django cache backend. Rendered HTML does not
+    depend on the user itself, only on which nodes the user can see, so
+    entries are keyed on a visibility signature and shared between users
+    with the same permissions.
+    """
+    key_prefix = 'navutils:menu'
+
+    def __init__(self, alias='default', timeout=300):
+        self.alias = alias
+        self.timeout = timeout
+
+    @property
+    def backend(self):
+        return caches[self.alias]
+
+    def get_generation(self, menu_id):
+        """
+        Return a token that changes each time the menu is invalidated. A
+        random token is used (rather than a counter) so an evicted token never
+        brings back stale entries.
+        """
+        key = '{0}:{1}:generation'.format(self.key_prefix, menu_id)
+        generation = self.backend.get(key)
+        if generation is None:
+            self.backend.add(key, uuid.uuid4().hex, None)
+            generation = self.backend.get(key)
+        return generation
+
+    def invalidate(self, menu_id):
+        key = '{0}:{1}:generation'.format(self.key_prefix, menu_id)
+        self.backend.set(key, uuid.uuid4().hex, None)
+
+    def get_visibility_signature(self, menu, user, context, max_depth):
+        """
+        Walk the nodes the same way rendering does and return a bitmap of the
+        visible ones, as an hexadecimal string. Dynamic children are not part
+        of the menu structure, so the fingerprints of the visible ones follow.
+        """
+        get_children = get_children_getter(context)
+        bitmap = 0
+        position = 0
+        fingerprints = []
+        stack = [
+            (node, 0, False) for node in sorted(menu.values(), key=lambda i: i.weight, reverse=True)
+        ]
+        stack.reverse()
+        while stack:
+            node, depth, dynamic = stack.pop()
+            if is_viewable(node, user, context):
+                bitmap |= 1 << position
+                if dynamic:
+                    fingerprints.append('{0}@{1}'.format(node.get_fingerprint(), depth))
+                if depth + 1 <= max_depth:
+                    children_dynamic = dynamic or hasattr(node._children, '__call__')
+                    stack.extend(
+                        (child, depth + 1, children_dynamic) for child in reversed(get_children(node)))
+            position += 1
+        return '|'.join(['{0:x}'.format(bitmap)] + fingerprints)
+
+    def get_key(self, menu, user, context, current_menu_item, max_depth):
+        signature = '|'.join([
+            # the menu definition may differ between processes during a deployment
+            menu.get_structure_hash(),
+            self.get_visibility_signature(menu, user, context, max_depth),
+            str(current_menu_item),
+            str(max_depth),
+            str(translation.get_language()),
+        ])
+        return '{0}:{1}:{2}:{3}'.format(
+            self.key_prefix,
+            menu.id,
+            self.get_generation(menu.id),
+            hashlib.sha1(signature.encode('utf-8')).hexdigest(),
+        )
+
+    def get(self, key):
+        return self.backend.get(key)
+
+    def set(self, key, output):
+        self.backend.set(key, str(output), self.timeout)
+
+
+def get_fragment_cache(menu):
+    """
+    Return the :py:class:`MenuFragmentCache` to use for the given menu, or
+    ``None`` if the menu should not be cached
+    """
+    from navutils import settings
+
+    alias = settings.NAVUTILS_MENU_CONFIG['FRAGMENT_CACHE']
+    enabled = getattr(menu, 'cache', None)
+    if enabled is None:
+        enabled = alias is not None
+    if not enabled:
+        return None
+    return MenuFragmentCache(
+        alias=alias or 'default',
+        timeout=settings.NAVUTILS_MENU_CONFIG['FRAGMENT_CACHE_TIMEOUT'],
+    )
+
+
+def invalidate_menu(menu):
+    """
+    Drop the rendered fragments of the given menu (or menu id), in every
+    process sharing the cache backend
+    """
+    from navutils import settings
+
+    menu_id = getattr(menu, 'id', menu)
+    alias = settings.NAVUTILS_MENU_CONFIG['FRAGMENT_CACHE'] or 'default'
+    MenuFragmentCache(alias=alias).invalidate(menu_id)
+
+
+# invalidation key -> nodes whose dynamic children are cached until this key
+# is invalidated
+_children_keys = {}
+_children_keys_lock = threading.Lock()
+
+
+def register_children_keys(node, keys):
+    with _children_keys_lock:
+        for key in keys:
+            _children_keys.setdefault(key, weakref.WeakSet()).add(node)
+
+
+def invalidate_children(*keys):
+    """
+    Drop the cached dynamic children of every node registered with one of the
+    given ``children_cache_keys``. Only the current process is affected, other
+    ones rely on ``children_timeout``.
+    """
+    with _children_keys_lock:
+        nodes = set()
+        for key in keys:
+            nodes.update(_children_keys.get(key, ()))
+    for node in nodes:
+        node.invalidate_children()
+
+
+def invalidate_children_on_save(model, keys=None):
+    """
+    Invalidate cached dynamic children each time an instance of the given model
+    is saved or deleted.
+
+    :param model: a model class, or a ``'app_label.ModelName'`` string
+    :param list keys: the keys to invalidate, default to the model label
+    """
+    from django.db.models.signals import post_delete, post_save
+
+    if keys is None:
+        keys = [model if isinstance(model, str) else model._meta.label]
+    keys = tuple(keys)
+
+    def receiver(**kwargs):
+        invalidate_children(*keys)
+
+    for signal in (post_save, post_delete):
+        signal.connect(
+            receiver,
+            sender=model,
+            weak=False,
+            dispatch_uid=('navutils.invalidate_children', keys),
+        )
+    return receiver
+
+
+# settings that can change the outcome of a reverse() call
+REVERSE_SETTINGS = (
+    'ROOT_URLCONF',
+    'FORCE_SCRIPT_NAME',
+    'LANGUAGE_CODE',
+    'LANGUAGES',
+    'USE_I18N',
+    'NAVUTILS_MENU_CONFIG',
+)
+
+_reverse_cache = None
+
+
+def get_reverse_cache():
+    global _reverse_cache
+    if _reverse_cache is None:
+        from navutils import settings
+        _reverse_cache = LRUCache(settings.NAVUTILS_MENU_CONFIG['REVERSE_CACHE_SIZE'])
+    return _reverse_cache
+
+
+def get_url_context():
+    """
+    Return what, besides the pattern name and its kwargs, can change the
+    outcome of a ``reverse()`` call in the current thread
+    """
+    return (get_urlconf(), get_script_prefix(), translation.get_language())
+
+
+def cached_reverse(pattern_name, kwargs=None):
+    """
+    Same as django's ``reverse``, but keep results in a process-local cache,
+    keyed on everything that can change the resulting URL: the reverse kwargs,
+    the active urlconf, script prefix and language
+    """
+    kwargs = kwargs or {}
+    key = (pattern_name, frozenset(kwargs.items())) + get_url_context()
+    try:
+        hash(key)
+    except TypeError:
+        # unhashable kwargs values, we cannot cache this one
+        if instrumentation.enabled:
+            instrumentation.reverse_called(pattern_name, kwargs, cached=False)
+        return reverse(pattern_name, kwargs=kwargs)
+
+    reverse_cache = get_reverse_cache()
+    url = reverse_cache.get(key)
+    if instrumentation.enabled:
+        instrumentation.reverse_called(pattern_name, kwargs, cached=url is not None)
+    if url is None:
+        url = reverse(pattern_name, kwargs=kwargs)
+        reverse_cache.set(key, url)
+    return url
+
+
+def clear_reverse_cache():
+    if _reverse_cache is not None:
+        _reverse_cache.clear()
+
+
+@receiver(setting_changed)
+def reset_reverse_cache(setting, **kwargs):
+    global _reverse_cache
+    if setting in REVERSE_SETTINGS:
+        clear_reverse_cache()
+    if setting == 'NAVUTILS_MENU_CONFIG':
+        # pick up the new cache size
+        _reverse_cache = None
@@ -0,0 +1,8 @@
+"""
+Menus stored in the database, so they can be edited in the admin. Add
+``navutils.db`` to your ``INSTALLED_APPS`` to use them.
+"""
+import django
+
+if django.VERSION < (3, 2):
+    default_app_config = 'navutils.db.apps.DbConfig'
@@ -0,0 +1,23 @@
+from django.contrib import admin
+
+from . import models
+
+
+class MenuNodeInline(admin.TabularInline):
+    model = models.MenuNode
+    fields = ('slug', 'label', 'parent', 'url', 'pattern_name', 'weight', 'visibility', 'permissions')
+    extra = 0
+
+
+@admin.register(models.Menu)
+class MenuAdmin(admin.ModelAdmin):
+    list_display = ('slug', 'css_class')
+    inlines = [MenuNodeInline]
+
+
+@admin.register(models.MenuNode)
+class MenuNodeAdmin(admin.ModelAdmin):
+    list_display = ('slug', 'label', 'menu', 'parent', 'url', 'pattern_name', 'weight', 'visibility')
+    list_filter = ('menu', 'visibility')
+    search_fields = ('slug', 'label', 'url', 'pattern_name')
+    list_select_related = ('menu', 'parent')
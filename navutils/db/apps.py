@@ -0,0 +1,17 @@
+from django.apps import AppConfig
+
+
+class DbConfig(AppConfig):
+    name = 'navutils.db'
+    label = 'navutils_db'
+    verbose_name = 'Menus'
+    default_auto_field = 'django.db.models.AutoField'
+
+    def ready(self):
+        from django.db.models.signals import post_delete, post_save
+
+        from . import loader, models
+
+        for signal in (post_save, post_delete):
+            signal.connect(loader.invalidate_on_save, sender=models.Menu, dispatch_uid='navutils.db.menu')
+            signal.connect(loader.invalidate_on_save, sender=models.MenuNode, dispatch_uid='navutils.db.node')
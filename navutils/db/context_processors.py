@@ -0,0 +1,5 @@
+from .loader import DatabaseMenus
+
+
+def menus(*args, **kwargs):
+    return {'db_menus': DatabaseMenus()}
@@ -0,0 +1,144 @@
+"""
+Build navutils menus from the menus stored in the database, and keep them in
+memory until they are edited.
+
+Each menu is built from a single query, after its pk is looked up on first
+access. Saving or deleting a menu or one of
+its nodes changes a token in the cache backend (the one of ``FRAGMENT_CACHE``,
+or ``default``), so every process sharing this backend builds the menu again
+on next access.
+"""
+import threading
+
+from navutils import cache, menu
+
+# slug -> (menu pk, generation token, built menu or None once invalidated)
+_menus = {}
+_lock = threading.Lock()
+
+
+def get_generation_cache():
+    from navutils import settings
+
+    return cache.MenuFragmentCache(alias=settings.NAVUTILS_MENU_CONFIG['FRAGMENT_CACHE'] or 'default')
+
+
+def get_generation_key(pk):
+    return 'db:{0}'.format(pk)
+
+
+def get_menu(slug):
+    """
+    :return: the :py:class:`navutils.menu.Menu` built from the database menu
+    with the given slug, built on first call and kept until the menu is edited
+    :raise KeyError: if there is no such menu
+    """
+    generations = get_generation_cache()
+    entry = _menus.get(slug)
+    pk = entry[0] if entry is not None else get_menu_pk(slug)
+    # read before loading: an edit made while loading forces another load next time
+    generation = generations.get_generation(get_generation_key(pk))
+    if entry is not None and entry[2] is not None and entry[1] == generation:
+        return entry[2]
+
+    loaded_pk, built = load_menu(slug)
+    with _lock:
+        if loaded_pk == pk:
+            _menus[slug] = (pk, generation, built)
+        else:
+            # the slug now belongs to another menu: look its pk up again next time
+            _menus.pop(slug, None)
+    return built
+
+
+def get_menu_pk(slug):
+    """
+    :raise KeyError: if there is no such menu
+    """
+    from .models import Menu
+
+    try:
+        return Menu.objects.values_list('pk', flat=True).get(slug=slug)
+    except Menu.DoesNotExist:
+        raise KeyError(slug)
+
+
+def load_menu(slug):
+    """
+    Query the nodes of a menu, along with the menu itself, and build it.
+
+    :return: a ``(menu pk, built menu)`` tuple
+    :raise KeyError: if there is no such menu
+    """
+    from .models import Menu, MenuNode
+
+    rows = list(MenuNode.objects.filter(menu__slug=slug).select_related('menu'))
+    if rows:
+        menu_row = rows[0].menu
+    else:
+        # an empty menu
+        try:
+            menu_row = Menu.objects.get(slug=slug)
+        except Menu.DoesNotExist:
+            raise KeyError(slug)
+    return menu_row.pk, build_menu(menu_row, rows)
+
+
+def build_menu(menu_row, rows):
+    """
+    :param menu_row: a :py:class:`navutils.db.models.Menu` instance
+    :param list rows: all its :py:class:`navutils.db.models.MenuNode` instances
+    :return: a :py:class:`navutils.menu.Menu`
+    """
+    children = {}
+    for row in rows:
+        children.setdefault(row.parent_id, []).append(row)
+
+    def build(row):
+        return row.to_node(children=[build(child) for child in children.get(row.pk, ())])
+
+    built = menu.Menu(menu_row.slug, css_class=menu_row.css_class or None)
+    for row in children.get(None, ()):
+        built.register(build(row))
+    return built
+
+
+def invalidate(pk):
+    """
+    Build the menu with the given pk again on next access, in every process
+    """
+    get_generation_cache().invalidate(get_generation_key(pk))
+    with _lock:
+        for slug, entry in list(_menus.items()):
+            if entry[0] == pk:
+                # keep the pk, so the menu is built again from a single query
+                _menus[slug] = (pk, None, None)
+
+
+def invalidate_on_save(sender, instance, **kwargs):
+    from .models import Menu
+
+    invalidate(instance.pk if isinstance(instance, Menu) else instance.menu_id)
+
+
+def clear():
+    """
+    Forget all the menus built by the current process
+    """
+    with _lock:
+        _menus.clear()
+
+
+class DatabaseMenus(object):
+    """
+    Give access to database menus by slug, e.g. ``db_menus.sidebar`` in
+    templates (see :py:func:`navutils.db.context_processors.menus`)
+    """
+    def __getitem__(self, slug):
+        return get_menu(slug)
+
+    def get(self, slug, default=None):
+        try:
+            return get_menu(slug)
+        except KeyError:
+            return default
@@ -0,0 +1,48 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:21
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Menu',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('slug', models.SlugField(help_text='The menu id, e.g. in templates', max_length=100, unique=True)),
+                ('css_class', models.CharField(blank=True, max_length=200)),
+            ],
+            options={
+                'ordering': ('slug',),
+            },
+        ),
+        migrations.CreateModel(
+            name='MenuNode',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('slug', models.SlugField(help_text='The node id, unique among its siblings', max_length=100)),
+                ('label', models.CharField(blank=True, max_length=200)),
+                ('url', models.CharField(blank=True, max_length=500)),
+                ('pattern_name', models.CharField(blank=True, help_text='The name of a URL pattern, used instead of the URL', max_length=200)),
+                ('divider', models.BooleanField(default=False)),
+                ('weight', models.IntegerField(default=0, help_text='Nodes with a higher weight come first')),
+                ('css_class', models.CharField(blank=True, max_length=200)),
+                ('visibility', models.CharField(choices=[('everyone', 'Everyone'), ('anonymous', 'Anonymous users'), ('authenticated', 'Authenticated users'), ('staff', 'Staff members')], default='everyone', max_length=20)),
+                ('permissions', models.TextField(blank=True, help_text='Required permissions, one per line, such as app_label.codename')),
+                ('require_all_permissions', models.BooleanField(default=True, help_text='Require all the permissions, instead of any of them')),
+                ('menu', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='nodes', to='navutils_db.menu')),
+                ('parent', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='children', to='navutils_db.menunode')),
+            ],
+            options={
+                'ordering': ('menu', '-weight', 'pk'),
+                'unique_together': {('menu', 'parent', 'slug')},
+            },
+        ),
+    ]
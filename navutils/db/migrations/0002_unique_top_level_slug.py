@@ -0,0 +1,17 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('navutils_db', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddConstraint(
+            model_name='menunode',
+            constraint=models.UniqueConstraint(condition=models.Q(('parent', None)), fields=('menu', 'slug'), name='navutils_unique_top_level_slug'),
+        ),
+    ]
@@ -0,0 +1,104 @@
+from django.core.exceptions import ValidationError
+from django.db import models
+
+from navutils import menu
+
+# node class to use for each visibility, when no permission is required
+VISIBILITY_NODES = {
+    'everyone': menu.Node,
+    'anonymous': menu.AnonymousNode,
+    'authenticated': menu.AuthenticatedNode,
+    'staff': menu.StaffNode,
+}
+
+
+class Menu(models.Model):
+    slug = models.SlugField(max_length=100, unique=True, help_text='The menu id, e.g. in templates')
+    css_class = models.CharField(max_length=200, blank=True)
+
+    class Meta:
+        ordering = ('slug',)
+
+    def __str__(self):
+        return self.slug
+
+
+class MenuNode(models.Model):
+    """
+    A node of a :py:class:`Menu`. Nodes are stored as an adjacency list: each
+    one points to its parent, top-level nodes have none.
+    """
+    menu = models.ForeignKey(Menu, on_delete=models.CASCADE, related_name='nodes')
+    parent = models.ForeignKey(
+        'self', on_delete=models.CASCADE, related_name='children', null=True, blank=True)
+    slug = models.SlugField(max_length=100, help_text='The node id, unique among its siblings')
+    label = models.CharField(max_length=200, blank=True)
+    url = models.CharField(max_length=500, blank=True)
+    pattern_name = models.CharField(
+        max_length=200, blank=True, help_text='The name of a URL pattern, used instead of the URL')
+    divider = models.BooleanField(default=False)
+    weight = models.IntegerField(default=0, help_text='Nodes with a higher weight come first')
+    css_class = models.CharField(max_length=200, blank=True)
+    visibility = models.CharField(
+        max_length=20,
+        default='everyone',
+        choices=[
+            ('everyone', 'Everyone'),
+            ('anonymous', 'Anonymous users'),
+            ('authenticated', 'Authenticated users'),
+            ('staff', 'Staff members'),
+        ],
+    )
+    permissions = models.TextField(
+        blank=True, help_text='Required permissions, one per line, such as app_label.codename')
+    require_all_permissions = models.BooleanField(
+        default=True, help_text='Require all the permissions, instead of any of them')
+
+    class Meta:
+        ordering = ('menu', '-weight', 'pk')
+        unique_together = ('menu', 'parent', 'slug')
+        constraints = [
+            # NULL parents never conflict in unique_together
+            models.UniqueConstraint(
+                fields=['menu', 'slug'], condition=models.Q(parent=None), name='navutils_unique_top_level_slug'),
+        ]
+
+    def __str__(self):
+        return self.label or self.slug
+
+    def get_permissions(self):
+        return self.permissions.split()
+
+    def clean(self):
+        if self.url and self.pattern_name:
+            raise ValidationError('Set either a URL or a pattern name, not both')
+        if self.divider and (self.url or self.pattern_name):
+            raise ValidationError('Dividers have neither a URL nor a pattern name')
+        if not self.divider and not (self.url or self.pattern_name):
+            raise ValidationError('Set a URL or a pattern name')
+        if self.get_permissions() and self.visibility != 'everyone':
+            raise ValidationError('Nodes requiring permissions should be visible by everyone')
+        if self.parent_id is not None and self.parent.menu_id != self.menu_id:
+            raise ValidationError('The parent node belongs to another menu')
+
+    def get_node_class(self):
+        if self.get_permissions():
+            return menu.AllPermissionsNode if self.require_all_permissions else menu.AnyPermissionsNode
+        return VISIBILITY_NODES[self.visibility]
+
+    def to_node(self, children=()):
+        """
+        :return: a :py:class:`navutils.menu.Node` built from this one
+        :param list children: the nodes built from the children of this one
+        """
+        kwargs = {
+            'url': self.url or None,
+            'pattern_name': self.pattern_name or None,
+            'divider': self.divider,
+            'weight': self.weight,
+            'css_class': self.css_class or None,
+            'children': list(children),
+        }
+        if self.get_permissions():
+            kwargs['permissions'] = self.get_permissions()
+        return self.get_node_class()(self.slug, self.label, **kwargs)
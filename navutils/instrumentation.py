@@ -0,0 +1,342 @@
+"""
+Optional measurements of menu, node, breadcrumbs and URL renderings.
+
+When enabled (see the ``INSTRUMENTATION`` setting), each top-level rendering
+is recorded in a :py:class:`RenderStats` holding its wall time and counters,
+then sent through the :py:data:`rendered` signal. Renderings that happen
+inside another one (nodes of a menu, URLs of a node...) are counted in the
+outer record instead.
+
+When disabled, instrumented code only checks the module-level ``enabled``
+flag.
+"""
+import bisect
+import contextvars
+import functools
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from django.dispatch import Signal
+
+logger = logging.getLogger(__name__)
+
+# sent with sender=RenderStats and stats=<RenderStats instance>
+rendered = Signal()
+
+enabled = False
+
+# the record of the rendering in progress
+_current = contextvars.ContextVar('navutils_render_stats', default=None)
+# the collectors that should receive finished records, see collect()
+_collectors = contextvars.ContextVar('navutils_collectors', default=())
+# whether new records should keep the details of what happened
+_detailed = contextvars.ContextVar('navutils_detailed', default=False)
+
+
+class RenderStats(object):
+    """
+    What happened during a rendering.
+
+    :param str kind: ``menu``, ``node``, ``breadcrumbs`` or ``url``
+    :param str name: the menu or node id
+    :param bool detailed: keep a list of what happened during the rendering,
+    in :py:attr:`events`
+    """
+    __slots__ = ('kind', 'name', 'duration', 'counters', 'events')
+
+    def __init__(self, kind, name, detailed=False):
+        self.kind = kind
+        self.name = name
+        self.duration = 0
+        # nodes_rendered, nodes_filtered, visibility_checks, url_calls,
+        # reverse_calls, reverse_cache_hits, template_loads,
+        # template_cache_hits, nested_compilations, children_calls,
+        # fragment_cache_hits, fragment_cache_misses
+        self.counters = {}
+        # (event type, data) tuples, see event()
+        self.events = [] if detailed else None
+
+    @property
+    def key(self):
+        return '{0}:{1}'.format(self.kind, self.name)
+
+    def as_dict(self):
+        data = {
+            'kind': self.kind,
+            'name': self.name,
+            'duration': self.duration,
+            'counters': dict(self.counters),
+        }
+        if self.events is not None:
+            data['events'] = [
+                dict(event_data, type=event_type) for event_type, event_data in self.events
+            ]
+        return data
+
+    def __repr__(self):
+        return '<RenderStats {0} {1:.3f}ms {2}>'.format(self.key, self.duration * 1000, self.counters)
+
+
+def count(name, value=1):
+    """
+    Add ``value`` to a counter of the rendering in progress, if any
+    """
+    stats = _current.get()
+    if stats is not None:
+        stats.counters[name] = stats.counters.get(name, 0) + value
+
+
+def event(event_type, **data):
+    """
+    Keep track of something that happened during the rendering in progress,
+    if it is detailed
+    """
+    stats = _current.get()
+    if stats is not None and stats.events is not None:
+        stats.events.append((event_type, data))
+
+
+def visibility_checked(node, viewable, duration):
+    count('visibility_checks')
+    if not viewable:
+        count('nodes_filtered')
+    event('visibility', node=node.id, node_type=type(node).__name__, viewable=bool(viewable), duration=duration)
+
+
+def reverse_called(pattern_name, kwargs, cached):
+    count('reverse_cache_hits' if cached else 'reverse_calls')
+    event('reverse', pattern_name=pattern_name, kwargs=repr(kwargs), cached=cached)
+
+
+def instrument(kind, get_name):
+    """
+    Record the calls of the decorated function, when instrumentation is
+    enabled. Calls made during another recorded rendering are only counted,
+    as ``<kind>_calls``.
+
+    :param callable get_name: called with the arguments of the function,
+    returns the name of the record
+    """
+    counter = '{0}_calls'.format(kind)
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return func(*args, **kwargs)
+            current = _current.get()
+            if current is not None:
+                count(counter)
+                if current.events is None:
+                    return func(*args, **kwargs)
+                start = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    event(kind, name=get_name(*args, **kwargs), duration=time.perf_counter() - start)
+
+            stats = RenderStats(kind, get_name(*args, **kwargs), detailed=_detailed.get())
+            token = _current.set(stats)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                stats.duration = time.perf_counter() - start
+                _current.reset(token)
+                finish(stats)
+        return wrapper
+    return decorator
+
+
+def finish(stats):
+    for collector in _collectors.get():
+        collector.append(stats)
+    rendered.send(sender=RenderStats, stats=stats)
+
+
+class Aggregator(object):
+    """
+    Sum the counters and build a histogram of the durations of the records
+    it receives, for each kind and name
+    """
+    # upper bounds of the histogram buckets, in seconds
+    buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.counters = {}
+            self.histograms = {}
+
+    def add(self, stats):
+        with self._lock:
+            counters = self.counters.setdefault(stats.key, {})
+            counters['renderings'] = counters.get('renderings', 0) + 1
+            for name, value in stats.counters.items():
+                counters[name] = counters.get(name, 0) + value
+
+            histogram = self.histograms.get(stats.key)
+            if histogram is None:
+                histogram = self.histograms[stats.key] = {
+                    'buckets': list(self.buckets),
+                    # the last count is for durations over the last bucket
+                    'counts': [0] * (len(self.buckets) + 1),
+                    'sum': 0,
+                    'count': 0,
+                }
+            histogram['counts'][bisect.bisect_left(self.buckets, stats.duration)] += 1
+            histogram['sum'] += stats.duration
+            histogram['count'] += 1
+
+    def append(self, stats):
+        self.add(stats)
+
+    def receive(self, stats, **kwargs):
+        self.add(stats)
+
+    def dump(self, reset=False):
+        """
+        :return: a JSON serializable copy of the counters and histograms
+        :param bool reset: start over once dumped, to report periodically
+        """
+        with self._lock:
+            data = {
+                'counters': {key: dict(value) for key, value in self.counters.items()},
+                'histograms': {
+                    key: dict(value, counts=list(value['counts']))
+                    for key, value in self.histograms.items()
+                },
+            }
+        if reset:
+            self.reset()
+        return data
+
+
+# receives all the records, while instrumentation is enabled
+aggregator = Aggregator()
+
+
+@contextmanager
+def collect(collector=None, detailed=False):
+    """
+    Gather the records of the renderings happening in the block, in the
+    current thread or task, e.g. for a single request::
+
+        with instrumentation.collect() as records:
+            response = view(request)
+
+    :param collector: a list, or an object with an ``append`` method such as
+    an :py:class:`Aggregator`. Defaults to a new list.
+    :param bool detailed: keep the details of each rendering, see
+    :py:attr:`RenderStats.events`
+    """
+    if collector is None:
+        collector = []
+    token = _collectors.set(_collectors.get() + (collector,))
+    detailed_token = _detailed.set(detailed or _detailed.get())
+    try:
+        yield collector
+    finally:
+        _detailed.reset(detailed_token)
+        _collectors.reset(token)
+
+
+def summarize(records, limit=10):
+    """
+    Sort out the details of the given records, as collected with
+    ``collect(detailed=True)``
+
+    :return: a JSON serializable dict with the renderings, visibility checks,
+    ``reverse()`` calls made more than once, callable children calls,
+    ``render_nested`` compilations and the ``limit`` slowest nodes. Durations
+    are converted to milliseconds.
+    """
+    renderings = []
+    visibility = []
+    reverse_calls = {}
+    children = []
+    compilations = []
+    nodes = []
+    for stats in records:
+        data = stats.as_dict()
+        events = data.pop('events', [])
+        data['duration'] *= 1000
+        renderings.append(data)
+        for event_data in events:
+            if event_data.get('duration') is not None:
+                event_data['duration'] *= 1000
+            event_type = event_data['type']
+            if event_type == 'visibility':
+                visibility.append(event_data)
+            elif event_type == 'reverse':
+                key = (event_data['pattern_name'], event_data['kwargs'])
+                reverse_calls[key] = reverse_calls.get(key, 0) + 1
+            elif event_type == 'children':
+                children.append(event_data)
+            elif event_type == 'nested_compilation':
+                compilations.append(event_data)
+            elif event_type == 'node':
+                nodes.append(event_data)
+
+    return {
+        'renderings': renderings,
+        'duration': sum(data['duration'] for data in renderings),
+        'visibility': visibility,
+        'slowest_visibility': sorted(visibility, key=lambda i: i['duration'] or 0, reverse=True)[:limit],
+        'repeated_reverse_calls': [
+            {'pattern_name': pattern_name, 'kwargs': kwargs, 'count': calls}
+            for (pattern_name, kwargs), calls in sorted(reverse_calls.items(), key=lambda i: -i[1])
+            if calls > 1
+        ],
+        'children_calls': children,
+        'nested_compilations': compilations,
+        'slowest_nodes': sorted(nodes, key=lambda i: i['duration'], reverse=True)[:limit],
+    }
+
+
+def enable():
+    global enabled
+    enabled = True
+    rendered.connect(aggregator.receive, sender=RenderStats, dispatch_uid='navutils.aggregator')
+
+
+def disable():
+    global enabled
+    enabled = False
+    rendered.disconnect(sender=RenderStats, dispatch_uid='navutils.aggregator')
+
+
+def configure():
+    """
+    Enable or disable instrumentation according to the ``INSTRUMENTATION`` setting
+    """
+    from navutils import settings
+
+    if settings.NAVUTILS_MENU_CONFIG['INSTRUMENTATION']:
+        enable()
+    else:
+        disable()
+
+
+class InstrumentationMiddleware(object):
+    """
+    Log a summary of the renderings of each request, on the
+    ``navutils.instrumentation`` logger, at the debug level
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not enabled:
+            return self.get_response(request)
+
+        request_aggregator = Aggregator()
+        with collect(request_aggregator):
+            response = self.get_response(request)
+        logger.debug('navutils renderings for %s: %s', request.path, request_aggregator.dump())
+        return response
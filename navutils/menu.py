@@ -1,46 +1,696 @@
+import hashlib
+import importlib.util
+import logging
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Mapping
+from operator import attrgetter
+from types import MappingProxyType
+from urllib.parse import urlsplit
+
+from django.utils.functional import Promise
+from persisting_theory import Registry
+
 try:
     # Django 1.10+
-    from django.urls import reverse
+    from django.urls import NoReverseMatch
 except ImportError:
-    from django.core.urlresolvers import reverse
+    from django.core.urlresolvers import NoReverseMatch
 
-from persisting_theory import Registry
+from . import cache, instrumentation, state
+from .permissions import get_permission_checker
+
+logger = logging.getLogger(__name__)
 
 
 class Menus(Registry):
     """ Keep a reference to all menus"""
     look_into = 'menu'
 
+    def __init__(self, *args, **kwargs):
+        # apps with a menu module that is not imported yet, see autodiscover()
+        self._pending_apps = []
+        # only set once all the pending apps are imported, so other threads
+        # wait for the import instead of reading a partly filled registry
+        self._discovered = True
+        self._discovering = False
+        self._discovery_lock = threading.RLock()
+        # app name -> seconds spent importing its menu module
+        self.discovery_times = OrderedDict()
+        super(Menus, self).__init__(*args, **kwargs)
+
     def prepare_name(self, data, name=None):
         return data.id
 
+    def autodiscover(self, apps, force_reload=False, lazy=False):
+        """
+        Import the menu module of the given apps.
+
+        :param bool lazy: only look for menu modules, and import them on first
+        access to the registry
+        """
+        apps = list(apps)
+        if not lazy:
+            for app in apps:
+                self.discover_app(app, force_reload=force_reload)
+            return
+
+        with self._discovery_lock:
+            for app in apps:
+                if importlib.util.find_spec('{0}.{1}'.format(app, self.look_into)) is not None:
+                    self._pending_apps.append(app)
+                    self._discovered = False
+
+    def discover_app(self, app, force_reload=False):
+        start = time.perf_counter()
+        super(Menus, self).autodiscover([app], force_reload=force_reload)
+        duration = self.discovery_times[app] = time.perf_counter() - start
+        logger.debug('Discovered menus of %s in %.2fms', app, duration * 1000)
+
+    def discover(self):
+        """
+        Import the menu modules found by a lazy :py:meth:`autodiscover`
+        """
+        with self._discovery_lock:
+            if self._discovering:
+                # a menu module of this thread reads the registry
+                return
+            self._discovering = True
+            try:
+                while self._pending_apps:
+                    self.discover_app(self._pending_apps[0])
+                    self._pending_apps.pop(0)
+                self._discovered = True
+            finally:
+                self._discovering = False
+
+    # accessing menus triggers the pending discovery
+
+    def __getitem__(self, key):
+        if not self._discovered:
+            self.discover()
+        return super(Menus, self).__getitem__(key)
+
+    def __contains__(self, key):
+        if not self._discovered:
+            self.discover()
+        return super(Menus, self).__contains__(key)
+
+    def __iter__(self):
+        if not self._discovered:
+            self.discover()
+        return super(Menus, self).__iter__()
+
+    def __len__(self):
+        if not self._discovered:
+            self.discover()
+        return super(Menus, self).__len__()
+
+    def get(self, key, default=None):
+        if not self._discovered:
+            self.discover()
+        return super(Menus, self).get(key, default)
+
+    def keys(self):
+        if not self._discovered:
+            self.discover()
+        return super(Menus, self).keys()
+
+    def values(self):
+        if not self._discovered:
+            self.discover()
+        return super(Menus, self).values()
+
+    def items(self):
+        if not self._discovered:
+            self.discover()
+        return super(Menus, self).items()
+
+    def find(self, menu_id, node_id, default=None):
+        """
+        :return: the node with the given qualified id in the given menu, or
+        ``default`` if there is no such menu or node
+        """
+        menu = self.get(menu_id)
+        if menu is None:
+            return default
+        return menu.find(node_id, default)
+
+    def match(self, path, view_name=None, view_kwargs=None):
+        """
+        :return: the id of the node matching a URL in any menu, or ``None``.
+        Nodes whose pattern name is ``view_name`` (and whose reverse kwargs
+        are all in ``view_kwargs``) come first, then the node with the
+        longest URL prefix of ``path``. See :py:class:`UrlIndex`.
+        """
+        indexes = [menu.compile().get_url_index() for menu in self.values()]
+        if view_name:
+            for index in indexes:
+                node_id = index.match_view(view_name, view_kwargs or {})
+                if node_id is not None:
+                    return node_id
+
+        best, best_depth = None, -1
+        for index in indexes:
+            node_id, depth = index.match_path(path)
+            if depth > best_depth:
+                best, best_depth = node_id, depth
+        return best
+
+    def match_request(self, request):
+        """
+        Same as :py:meth:`match`, with the path and resolved view of a request
+        """
+        resolver_match = getattr(request, 'resolver_match', None)
+        if resolver_match is None:
+            return self.match(request.path)
+        return self.match(request.path, resolver_match.view_name, resolver_match.kwargs)
+
+
 registry = Menus()
 register = registry.register
 
 
 class Menu(Registry):
     """A collection of nodes"""
+
+    # attributes describing the menu itself, setting one of them is a
+    # structure change
+    hashed_attributes = ('id', 'css_class', 'template', 'context')
+
     def __init__(self, id, *args, **kwargs):
+        # incremented on each structure change, see touch()
+        self.version = 0
+        # see get_structure_hash()
+        self._structure_hash = None
         self.id = id
         self.css_class = kwargs.pop('css_class', None)
         self.template = kwargs.pop('template', 'navutils/menu.html')
         self.context = kwargs.pop('context', {})
+        # None means "use the NATIVE_RENDERER setting"
+        self.native = kwargs.pop('native', None)
+        # None means "use the FRAGMENT_CACHE setting"
+        self.cache = kwargs.pop('cache', None)
+        # qualified id -> node, built on first call to find()
+        self._index = None
+        # compiled forms of the menu, see compile()
+        self._compiled = {}
         super(Menu, self).__init__(*args, **kwargs)
 
+    def __setattr__(self, name, value):
+        super(Menu, self).__setattr__(name, value)
+        if name in self.hashed_attributes and '_compiled' in self.__dict__:
+            self.touch()
+
+    def __setitem__(self, key, node):
+        if key in self:
+            self.unindex_nodes([self[key]])
+        super(Menu, self).__setitem__(key, node)
+        node._menu = self
+        self.index_nodes([node])
+        self.touch()
+
+    def __delitem__(self, key):
+        node = self[key]
+        self.unindex_nodes([node])
+        super(Menu, self).__delitem__(key)
+        node._menu = None
+        self.touch()
+
+    # the methods below bypass __setitem__ and __delitem__ in OrderedDict
+
+    def pop(self, key, *default):
+        if key not in self:
+            return super(Menu, self).pop(key, *default)
+        node = self[key]
+        del self[key]
+        return node
+
+    def popitem(self, last=True):
+        if not self:
+            raise KeyError('menu is empty')
+        key = next(reversed(self)) if last else next(iter(self))
+        return key, self.pop(key)
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def clear(self):
+        nodes = list(self.values())
+        self.unindex_nodes(nodes)
+        super(Menu, self).clear()
+        for node in nodes:
+            node._menu = None
+        self.touch()
+
+    def unregister(self, id):
+        """
+        Remove a node from the menu
+
+        :param str id: the id of the node
+        """
+        del self[id]
+
+    def touch(self):
+        """
+        Called each time the menu structure changes. Mark the compiled forms
+        and the structure hash of the menu as stale.
+        """
+        self._compiled = {}
+        self._structure_hash = None
+        self.version += 1
+
+    def find(self, node_id, default=None):
+        """
+        :param str node_id: the qualified id of a node, such as ``parent:child``
+        :return: the node, or ``default`` if there is none. Dynamic children
+        are not indexed.
+        """
+        if self._index is None:
+            index = {}
+
+            def add(node):
+                index[node.id] = node
+            walk_nodes(self.values(), add)
+            self._index = index
+        return self._index.get(node_id, default)
+
+    def index_nodes(self, nodes):
+        """
+        Add the given nodes, and their descendants, to the index used by
+        :py:meth:`find`, if it was built already
+        """
+        index = self._index
+        if index is None:
+            return
+
+        def add(node):
+            index[node.id] = node
+        walk_nodes(nodes, add)
+
+    def unindex_nodes(self, nodes):
+        """
+        Remove the given nodes, and their descendants, from the index used by
+        :py:meth:`find`
+        """
+        index = self._index
+        if index is None:
+            return
+
+        def remove(node):
+            if index.get(node.id) is node:
+                del index[node.id]
+        walk_nodes(nodes, remove)
+
+    def compile(self):
+        """
+        :return: a :py:class:`CompiledMenu`, built on first call and kept until
+        the menu structure changes. Since resolved URLs are part of the
+        compiled form, one is kept for each urlconf, script prefix and
+        language.
+        """
+        key = cache.get_url_context()
+        compiled = self._compiled.get(key)
+        if compiled is None:
+            compiled = self._compiled[key] = CompiledMenu(self)
+        return compiled
+
+    freeze = compile
+
+    def get_structure_hash(self):
+        """
+        :return: a hash of the menu and its nodes (see :py:meth:`Node.get_hash`),
+        computed again only after a structure change. Unlike :py:attr:`version`,
+        it is the same in every process for the same menu definition, so it can
+        be used in shared cache keys.
+        """
+        if self._structure_hash is None:
+            digest = hashlib.sha1(
+                get_fingerprint([getattr(self, name) for name in self.hashed_attributes]).encode('utf-8'))
+            for node in sorted(self.values(), key=lambda i: i.weight, reverse=True):
+                digest.update(node.get_hash().encode('utf-8'))
+            self._structure_hash = digest.hexdigest()
+        return self._structure_hash
+
     def prepare_name(self, data, name=None):
         return data.id
 
+    def post_register(self, data, name):
+        from . import settings
+
+        if settings.NAVUTILS_MENU_CONFIG['PRELOAD_URLS']:
+            self.preload_urls([self[name]])
+
+    def preload_urls(self, nodes=None):
+        """
+        Reverse the URL of every node that does not need reverse kwargs, so
+        they are already cached on first render. Dynamic children are skipped.
+
+        :param list nodes: the nodes to preload, default to every node in the menu
+        """
+        stack = list(self.values() if nodes is None else nodes)
+        while stack:
+            node = stack.pop()
+            if node.pattern_name and not node.reverse_kwargs:
+                node.get_url()
+            if not hasattr(node._children, '__call__'):
+                stack.extend(node._children)
+
     def get_context(self, context):
         context.update(self.context)
         return context
 
+    def invalidate(self):
+        """
+        Drop the cached renderings of this menu, see ``FRAGMENT_CACHE``
+        """
+        cache.invalidate_menu(self)
+
+
+class CompiledMenu(object):
+    """
+    An immutable, flattened form of a menu: nodes are stored in pre-order
+    (as they are rendered), with parallel tuples describing each node.
+
+    The descendants of the node at index ``i`` are stored at indexes
+    ``i + 1`` to ``ends[i] - 1``, so a whole subtree can be skipped by
+    jumping to ``ends[i]``. Dynamic children (callables) are not flattened,
+    the corresponding nodes are flagged in ``dynamic``.
+    """
+    __slots__ = (
+        'nodes',
+        'ids',
+        'depths',
+        'parents',
+        'ends',
+        'urls',
+        'predicates',
+        'dynamic',
+        'positions',
+        '_url_index',
+    )
+
+    def __init__(self, menu):
+        nodes, depths, parents, ends = [], [], [], []
+        roots = sorted(menu.values(), key=lambda i: i.weight, reverse=True)
+        # a None node marks the end of the subtree of the node at given index
+        stack = [(node, 0, -1) for node in reversed(roots)]
+        while stack:
+            node, depth, parent = stack.pop()
+            if node is None:
+                ends[parent] = len(nodes)
+                continue
+            index = len(nodes)
+            nodes.append(node)
+            depths.append(depth)
+            parents.append(parent)
+            ends.append(index + 1)
+            if not hasattr(node._children, '__call__') and node._children:
+                stack.append((None, None, index))
+                stack.extend((child, depth + 1, index) for child in reversed(node._children))
+
+        self.nodes = tuple(nodes)
+        self.ids = tuple(node.id for node in nodes)
+        self.depths = tuple(depths)
+        self.parents = tuple(parents)
+        self.ends = tuple(ends)
+        self.urls = tuple(self.resolve_url(node) for node in nodes)
+        self.predicates = tuple(node.is_viewable_by for node in nodes)
+        self.dynamic = tuple(hasattr(node._children, '__call__') for node in nodes)
+        self.positions = {}
+        for index, node_id in enumerate(self.ids):
+            self.positions.setdefault(node_id, index)
+        self._url_index = None
+
+    def resolve_url(self, node):
+        """
+        Return the URL of the node, or ``None`` if it cannot be known in
+        advance (dividers, nodes with a custom ``get_url`` or that need reverse
+        kwargs, patterns that cannot be reversed)
+        """
+        if node.is_divider or type(node).get_url is not Node.get_url:
+            return None
+        if node.pattern_name and node.reverse_kwargs:
+            return None
+        try:
+            return node.get_url()
+        except NoReverseMatch:
+            # may be a node that is never visible with this urlconf: leave it
+            # to rendering, that only reverses visible nodes
+            return None
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def get_url_index(self):
+        """
+        :return: the :py:class:`UrlIndex` of the nodes, built on first call
+        """
+        if self._url_index is None:
+            self._url_index = UrlIndex(self)
+        return self._url_index
+
+    def get_current_lineage(self, current, get_children=state.get_children, viewable_roots=None):
+        """
+        Same as :py:func:`get_current_lineage`, using the parent indexes
+
+        :param viewable_roots: the top-level nodes the user can see. If given,
+        the dynamic children of the other ones are not generated, as when
+        rendering through templates.
+        """
+        if current is None:
+            return set()
+
+        position = self.positions.get(current)
+        lineage = set()
+        if position is None:
+            if viewable_roots is not None:
+                viewable_roots = set(map(id, viewable_roots))
+            # the node may be a dynamic child
+            for index, dynamic in enumerate(self.dynamic):
+                if dynamic:
+                    if viewable_roots is not None and id(self.nodes[self.get_root(index)]) not in viewable_roots:
+                        continue
+                    children = get_children(self.nodes[index])
+                    lineage = get_current_lineage(children, current, get_children)
+                    if lineage:
+                        position = index
+                        break
+            else:
+                return lineage
+
+        while position != -1:
+            lineage.add(self.ids[position])
+            position = self.parents[position]
+        return lineage
+
+    def get_root(self, index):
+        """
+        :return: the index of the top-level ancestor of the node at ``index``
+        """
+        while self.parents[index] != -1:
+            index = self.parents[index]
+        return index
+
+
+class PathTrie(object):
+    """
+    Map URL paths to values, one level per path segment, so the value of the
+    longest prefix of a path is found in a single walk down the trie
+    """
+    __slots__ = ('children', 'value')
+
+    def __init__(self):
+        self.children = {}
+        self.value = None
+
+    def insert(self, path, value):
+        """
+        Map ``path`` to ``value``, unless it is mapped already
+        """
+        trie = self
+        for segment in path.split('/'):
+            if segment:
+                child = trie.children.get(segment)
+                if child is None:
+                    child = trie.children[segment] = PathTrie()
+                trie = child
+        if trie.value is None:
+            trie.value = value
+
+    def match(self, path):
+        """
+        :return: a ``(value, depth)`` tuple for the longest prefix of ``path``
+        with a value, or ``(None, -1)``. The root path only matches itself.
+        """
+        segments = [segment for segment in path.split('/') if segment]
+        if not segments:
+            return (self.value, 0) if self.value is not None else (None, -1)
+
+        value, depth = None, -1
+        trie = self
+        for current_depth, segment in enumerate(segments, 1):
+            trie = trie.children.get(segment)
+            if trie is None:
+                break
+            if trie.value is not None:
+                value, depth = trie.value, current_depth
+        return value, depth
+
+
+class UrlIndex(object):
+    """
+    Find the node matching a URL path or a resolved view, among the nodes of
+    a :py:class:`CompiledMenu`. Dynamic children are not indexed, and when
+    several nodes share a URL, the first one in the menu wins.
+    """
+    __slots__ = ('paths', 'views')
+
+    def __init__(self, compiled):
+        self.paths = PathTrie()
+        # pattern name -> [(node id, reverse kwargs)], most reverse kwargs first
+        self.views = {}
+        # URLs that cannot be known in advance (e.g. patterns missing from
+        # the urlconf) are None: these nodes are only found by pattern name
+        for node, url in zip(compiled.nodes, compiled.urls):
+            if url:
+                parts = urlsplit(url)
+                if not parts.scheme and not parts.netloc and parts.path.startswith('/'):
+                    self.paths.insert(parts.path, node.id)
+            if node.pattern_name:
+                self.views.setdefault(node.pattern_name, []).append((node.id, tuple(node.reverse_kwargs)))
+        for candidates in self.views.values():
+            candidates.sort(key=lambda i: len(i[1]), reverse=True)
+
+    def match_path(self, path):
+        """
+        :return: a ``(node id, depth)`` tuple for the node whose URL is the
+        longest prefix of ``path``, or ``(None, -1)``
+        """
+        return self.paths.match(path)
+
+    def match_view(self, view_name, view_kwargs):
+        """
+        :return: the id of the first node whose pattern name is ``view_name``
+        and whose reverse kwargs are all in ``view_kwargs``, or ``None``
+        """
+        for node_id, reverse_kwargs in self.views.get(view_name, ()):
+            if all(key in view_kwargs for key in reverse_kwargs):
+                return node_id
+        return None
+
+
+# shared by all nodes that don't need their own attrs, link_attrs, context...
+EMPTY_MAPPING = MappingProxyType({})
+
+
+def normalize(value):
+    """
+    Turn a value into one whose ``repr()`` does not depend on the process:
+    mappings are sorted, lazy translations and callables are replaced by
+    their text and name
+    """
+    if isinstance(value, Mapping):
+        return sorted((str(key), normalize(item)) for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        return tuple(normalize(item) for item in value)
+    if isinstance(value, Promise):
+        return str(value)
+    if callable(value):
+        return '{0}.{1}'.format(getattr(value, '__module__', ''), getattr(value, '__qualname__', ''))
+    return value
+
+
+def get_fingerprint(values):
+    return repr(normalize(values))
+
+
+def tracked_attribute(name):
+    """
+    :return: a property for the ``name`` attribute of nodes, stored in the
+    ``_<name>`` slot, that touches the node when set (see
+    :py:meth:`Node.touch`). Reading it stays a C-level slot lookup, and
+    constructors set the slot directly.
+    """
+    slot = '_' + name
+
+    def set_value(node, value):
+        setattr(node, slot, value)
+        node.touch()
+
+    return property(attrgetter(slot), set_value)
+
+
 class Node(object):
 
-    parent = None
+    # large menus can hold a lot of nodes, so we avoid a per-instance __dict__.
+    # Subclasses that don't declare __slots__ themselves still get one.
+    __slots__ = (
+        '_id',
+        '_parent',
+        '_path',
+        '_menu',
+        '_hash',
+        '_version',
+        '_children',
+        '_children_cache',
+        'children_timeout',
+        'children_cache_keys',
+        # the values of hashed_attributes, see tracked_attribute()
+        '_pattern_name',
+        '_url',
+        '_is_divider',
+        '_label',
+        '_weight',
+        '_template',
+        '_css_class',
+        '_reverse_kwargs',
+        '_link_attrs',
+        '_attrs',
+        '_context',
+        'kwargs',
+        '__weakref__',
+    )
+
+    # if False, is_viewable_by is called each time the node visibility is checked
+    # during a rendering. Otherwise, the result is reused for the whole rendering.
+    cache_visibility = True
+
+    # attributes describing the node, see get_fingerprint(). Setting one of
+    # them is a structure change, see touch()
+    hashed_attributes = (
+        'label',
+        'pattern_name',
+        'url',
+        'reverse_kwargs',
+        'is_divider',
+        'weight',
+        'template',
+        'css_class',
+        'attrs',
+        'link_attrs',
+        'context',
+    )
+    label = tracked_attribute('label')
+    pattern_name = tracked_attribute('pattern_name')
+    url = tracked_attribute('url')
+    reverse_kwargs = tracked_attribute('reverse_kwargs')
+    is_divider = tracked_attribute('is_divider')
+    weight = tracked_attribute('weight')
+    template = tracked_attribute('template')
+    css_class = tracked_attribute('css_class')
+    attrs = tracked_attribute('attrs')
+    link_attrs = tracked_attribute('link_attrs')
+    context = tracked_attribute('context')
 
     def __init__(self, id, label, pattern_name=None, url=None, divider=False, weight=0, title=None,
                  template='navutils/node.html', children=[], css_class=None, submenu_css_class=None,
-                 reverse_kwargs=[], attrs={}, link_attrs={}, context={}, **kwargs):
+                 reverse_kwargs=(), attrs=EMPTY_MAPPING, link_attrs=EMPTY_MAPPING,
+                 context=EMPTY_MAPPING, children_timeout=None, children_cache_keys=(),
+                 **kwargs):
         """
         :param str id: a unique identifier for further retrieval
         :param str label: a label for the node, that will be displayed in templates
@@ -66,6 +716,10 @@ class Node(object):
         html
         :param dict link_attrs: a dictionnary of attributes to apply to the node
         link html
+        :param int children_timeout: when ``children`` is a callable, keep its\
+        result for this number of seconds instead of calling it on each rendering
+        :param list children_cache_keys: when ``children`` is a callable, keep its\
+        result until one of these keys is passed to :py:func:`invalidate_children`
         """
         if pattern_name and url:
             raise ValueError('MenuNode accepts either a url or a pattern_name arg, but not both')
@@ -75,39 +729,146 @@ class Node(object):
             raise ValueError('MenuNode divider should have neither url nor pattern_name args')
 
         self._id = id
-        self.pattern_name = pattern_name
-        self.url = url
-        self.is_divider = divider
-        self.label = label
-        self.weight = weight
-        self.template = template
-        self.css_class = css_class
-        self.reverse_kwargs = reverse_kwargs
-        self.link_attrs = link_attrs
-        self.attrs = attrs
-        self.context = context
-        self.kwargs = kwargs
-
-        if 'class' in self.attrs:
+        self._parent = None
+        # (qualified id, depth), computed on first access
+        self._path = None
+        # the menu this node is registered in, for top-level nodes
+        self._menu = None
+        # hash of the subtree, computed on first access, see get_hash()
+        self._hash = None
+        self._version = 0
+        # set the slots behind the tracked attributes, nothing changed yet
+        self._pattern_name = pattern_name
+        self._url = url
+        self._is_divider = divider
+        self._label = label
+        self._weight = weight
+        self._template = template
+        self._css_class = css_class
+        self._reverse_kwargs = reverse_kwargs or ()
+        self._link_attrs = link_attrs or EMPTY_MAPPING
+        self._attrs = attrs or EMPTY_MAPPING
+        self._context = context or EMPTY_MAPPING
+        self.kwargs = kwargs or EMPTY_MAPPING
+
+        if 'class' in self._attrs:
             raise ValueError('CSS class is handled via  the css_class argument, don\'t use attrs for this purpose')
 
         self._children = children
+        # (expiration time, children), for cached dynamic children
+        self._children_cache = None
+        self.children_timeout = children_timeout
+        self.children_cache_keys = tuple(children_cache_keys)
+        if self.children_cache_keys:
+            cache.register_children_keys(self, self.children_cache_keys)
 
         if not hasattr(self._children, '__call__'):
             self._children = []
-            for node in children:
-                self.add(node)
+            if children:
+                self.add_many(children)
 
     def get_context(self, context):
         context.update(self.context)
         return context
 
+    def get_fingerprint(self):
+        """
+        :return: a string describing this node, but not its children, built
+        from its :py:attr:`hashed_attributes`
+        """
+        dynamic_children = self._children if hasattr(self._children, '__call__') else None
+        values = [type(self).__module__, type(self).__name__, self._id, dynamic_children]
+        return get_fingerprint(values + [getattr(self, name) for name in self.hashed_attributes])
+
+    def get_hash(self):
+        """
+        :return: a hash of this node and its descendants, the same in every
+        process for the same definitions. It is computed once, then again only
+        for the nodes that changed and their ancestors. Dynamic children are
+        only represented by the name of the callable.
+        """
+        if self._hash is None:
+            digest = hashlib.sha1(self.get_fingerprint().encode('utf-8'))
+            if not hasattr(self._children, '__call__'):
+                for child in self._children:
+                    digest.update(child.get_hash().encode('utf-8'))
+            self._hash = digest.hexdigest()
+        return self._hash
+
+    @property
+    def version(self):
+        """
+        A counter incremented each time this node or one of its descendants
+        changes. Cheaper than :py:meth:`get_hash`, but only meaningful in the
+        current process.
+        """
+        return self._version
+
     @property
     def children(self):
         if hasattr(self._children, '__call__'):
-            return self._children()
+            if not self.caches_children:
+                return state.resolve(self.generate_children())
+            return self.get_cached_children()
         return self._children
 
+    def generate_children(self):
+        """
+        Call the ``children`` callable
+        """
+        if not instrumentation.enabled:
+            return self._children()
+
+        start = time.perf_counter()
+        children = self._children()
+        instrumentation.count('children_calls')
+        instrumentation.event('children', node=self.id, duration=time.perf_counter() - start)
+        return children
+
+    @property
+    def caches_children(self):
+        return self.children_timeout is not None or bool(self.children_cache_keys)
+
+    def get_cached_children(self):
+        """
+        :return: the result of the ``children`` callable, as long as it is not
+        older than :py:attr:`children_timeout` and was not invalidated
+        """
+        children = self.get_children_cache()
+        if children is None:
+            children = self.set_children_cache(state.resolve(self.generate_children()))
+        return children
+
+    def get_children_cache(self):
+        """
+        :return: the cached children, or ``None`` if there are none or they expired
+        """
+        cached = self._children_cache
+        if cached is not None and (cached[0] is None or cached[0] > time.monotonic()):
+            return cached[1]
+        return None
+
+    def set_children_cache(self, children):
+        children = list(children)
+        expires = None
+        if self.children_timeout is not None:
+            expires = time.monotonic() + self.children_timeout
+        self._children_cache = (expires, children)
+        return children
+
+    def invalidate_children(self):
+        """
+        Forget the cached result of the ``children`` callable, along with the
+        cached renderings of the menu, if any
+        """
+        self._children_cache = None
+        menu = self.get_menu()
+        if menu is not None:
+            fragment_cache = cache.get_fragment_cache(menu)
+            if fragment_cache is not None:
+                fragment_cache.invalidate(menu.id)
+
+    @instrumentation.instrument('url', lambda node, **kwargs: node.id)
     def get_url(self, **kwargs):
         """
         :param kwargs: a dictionary of values that will be used for reversing,\
@@ -120,35 +881,136 @@ class Node(object):
                 key: value for key, value in kwargs.items()
                 if key in self.reverse_kwargs
             }
-            return reverse(self.pattern_name, kwargs=expected_kwargs)
+            return cache.cached_reverse(self.pattern_name, kwargs=expected_kwargs)
         return self.url
 
     def add(self, node):
         """
-        Add a new node to the instance children and sort them by weight.
+        Add a new node to the instance children, after the children with the
+        same or a greater weight.
 
         :param node: A node instance
         """
         node.parent = self
-        self._children.append(node)
-        self._children = sorted(
-            self._children,
-            key=lambda i: i.weight,
-            reverse=True
-        )
+        # children are sorted by decreasing weight, look for the first lighter one
+        low, high = 0, len(self._children)
+        while low < high:
+            middle = (low + high) // 2
+            if self._children[middle].weight < node.weight:
+                high = middle
+            else:
+                low = middle + 1
+        self._children.insert(low, node)
+        menu = self.get_menu()
+        if menu is not None:
+            menu.index_nodes([node])
+        self.touch()
+
+    def add_many(self, nodes):
+        """
+        Add several nodes to the instance children and sort them by weight,
+        only once. The resulting order is the same as calling :py:meth:`add`
+        for each node.
+
+        :param nodes: An iterable of node instances
+        """
+        nodes = list(nodes)
+        for node in nodes:
+            node.parent = self
+            self._children.append(node)
+        self._children.sort(key=lambda i: i.weight, reverse=True)
+        menu = self.get_menu()
+        if menu is not None:
+            menu.index_nodes(nodes)
+        self.touch()
+
+    extend = add_many
 
     def is_viewable_by(self, user, context={}):
         return True
 
+    def remove(self, node):
+        """
+        Remove a node from the instance children.
+
+        :param node: A node instance
+        """
+        menu = self.get_menu()
+        if menu is not None:
+            # while the ids of the removed nodes still include this node id
+            menu.unindex_nodes([node])
+        self._children.remove(node)
+        node.parent = None
+        self.touch()
+
+    def touch(self):
+        """
+        Called each time the subtree of this node changes: update the version
+        and hash of the node and its ancestors, and notify the menu the root
+        node is registered in. Setting a tracked attribute calls it, so
+        replace mappings rather than changing them in place (e.g.
+        ``node.attrs = dict(node.attrs, title='Title')``), or call it after
+        changing a mutable value of your own in place.
+        """
+        node = self
+        while True:
+            node._hash = None
+            node._version += 1
+            if node._parent is None:
+                break
+            node = node._parent
+        if node._menu is not None:
+            node._menu.touch()
+
+    def get_menu(self):
+        """
+        :return: the menu this node, or its root node, is registered in, if any
+        """
+        node = self
+        while node._parent is not None:
+            node = node._parent
+        return node._menu
+
+    @property
+    def parent(self):
+        return self._parent
+
+    @parent.setter
+    def parent(self, parent):
+        self._parent = parent
+        self.reset_path()
+
+    def reset_path(self):
+        """
+        Forget the cached id and depth of this node and its descendants, so they
+        are computed again from the new ancestors
+        """
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            if node._path is None:
+                # a path is never cached without the ones of its ancestors
+                continue
+            node._path = None
+            if not hasattr(node._children, '__call__'):
+                stack.extend(node._children)
+
+    def get_path(self):
+        if self._path is None:
+            if self.parent:
+                parent_id, parent_depth = self.parent.get_path()
+                self._path = ('{0}:{1}'.format(parent_id, self._id), parent_depth + 1)
+            else:
+                self._path = (self._id, 0)
+        return self._path
+
     @property
     def id(self):
-        if self.parent:
-            return '{0}:{1}'.format(self.parent.id, self._id)
-        return self._id
+        return self.get_path()[0]
 
     @property
     def depth(self):
-        return 0 if not self.parent else self.parent.depth + 1
+        return self.get_path()[1]
 
     def __repr__(self):
         return '<MenuNode {0}>'.format(self.label)
@@ -156,13 +1018,80 @@ class Node(object):
     def is_current(self, current):
         return self.id == current
 
-    def has_current(self, current, viewable_children):
-        return any([child.is_current(current) for child in viewable_children]) or any([child.has_current(current,child.children) for child in viewable_children])
+    def has_current(self, current, viewable_children, lineage=None):
+        """
+        :param current: the id of the current node
+        :param list viewable_children: the children of this node that are displayed
+        :param set lineage: the ids of the current node and its ancestors, as
+        returned by :py:func:`get_current_lineage`. Computed from
+        ``viewable_children`` if not provided.
+        :return: ``True`` if the current node is one of the viewable children,
+        or one of their descendants
+        """
+        if lineage is None:
+            lineage = get_current_lineage(viewable_children, current)
+        return any(child.id in lineage for child in viewable_children)
+
+
+def get_current_lineage(nodes, current, get_children=state.get_children):
+    """
+    Look for the node identified by ``current`` in the given nodes and their
+    descendants.
+
+    Since node ids are built from their parents ids, only the branch leading
+    to the current node is explored first. Dynamic children are not bound to
+    their parent, so their ids tell nothing about their position: if the
+    current node cannot be found this way, the whole tree is searched.
+
+    :return: a set containing the ids of the current node and all its
+    ancestors, or an empty set if the node cannot be found
+    """
+    if current is None:
+        return set()
+
+    nodes = list(nodes)
+    prefix = str(current)
+    lineage = find_lineage(
+        nodes, current, lambda node: prefix.startswith('{0}:'.format(node.id)), get_children)
+    if lineage is None:
+        lineage = find_lineage(nodes, current, lambda node: True, get_children)
+    return lineage or set()
+
+
+def walk_nodes(nodes, callback):
+    """
+    Call ``callback`` with each of the given nodes and their descendants.
+    Dynamic children are skipped.
+    """
+    stack = list(nodes)
+    while stack:
+        node = stack.pop()
+        callback(node)
+        if not hasattr(node._children, '__call__'):
+            stack.extend(node._children)
+
+
+def find_lineage(nodes, current, explore, get_children=state.get_children):
+    """
+    Depth-first search of the current node, only looking into the children
+    of nodes for which ``explore(node)`` is true
+    """
+    stack = [(node, ()) for node in reversed(nodes)]
+    while stack:
+        node, path = stack.pop()
+        if node.id == current:
+            return set(path) | {node.id}
+        if explore(node):
+            path = path + (node.id,)
+            stack.extend((child, path) for child in reversed(list(get_children(node))))
+    return None
 
 
 
 class AnonymousNode(Node):
     """Only viewable by anonymous users"""
+    __slots__ = ()
+
     def is_viewable_by(self, user, context={}):
         try:
             return not user.is_authenticated()
@@ -173,6 +1102,8 @@ class AnonymousNode(Node):
 
 class AuthenticatedNode(Node):
     """Only viewable by authenticated users"""
+    __slots__ = ()
+
     def is_viewable_by(self, user, context={}):
         try:
             return user.is_authenticated()
@@ -183,6 +1114,7 @@ class AuthenticatedNode(Node):
 
 class StaffNode(AuthenticatedNode):
     """Only viewable by staff members / admins"""
+    __slots__ = ()
 
     def is_viewable_by(self, user, context={}):
         return user.is_staff or user.is_superuser
@@ -190,45 +1122,72 @@ class StaffNode(AuthenticatedNode):
 
 class PermissionNode(Node):
     """Require that user has given permission to display"""
+    __slots__ = ('_permission',)
+
+    hashed_attributes = Node.hashed_attributes + ('permission',)
+    permission = tracked_attribute('permission')
+
+    # check the permission against all the user permissions, fetched once per
+    # rendering. Set to False in subclasses that need user.has_perm
+    batch_permissions = True
 
     def __init__(self, *args, **kwargs):
-        self.permission = kwargs.pop('permission')
+        self._permission = kwargs.pop('permission')
         super(PermissionNode, self).__init__(*args, **kwargs)
 
     def is_viewable_by(self, user, context={}):
-        return user.has_perm(self.permission)
+        has_perm = get_permission_checker(self, user, context)
+        return has_perm(self.permission)
 
 
 class AllPermissionsNode(Node):
     """Require user has all given permissions to display"""
+    __slots__ = ('_permissions',)
+
+    hashed_attributes = Node.hashed_attributes + ('permissions',)
+    permissions = tracked_attribute('permissions')
+    batch_permissions = True
 
     def __init__(self, *args, **kwargs):
-        self.permissions = kwargs.pop('permissions')
+        self._permissions = kwargs.pop('permissions')
         super(AllPermissionsNode, self).__init__(*args, **kwargs)
 
     def is_viewable_by(self, user, context={}):
-        return all([user.has_perm(perm) for perm in self.permissions])
+        has_perm = get_permission_checker(self, user, context)
+        return all(has_perm(perm) for perm in self.permissions)
 
 
 
 class AnyPermissionsNode(Node):
     """Require user has one of the given permissions to display"""
+    __slots__ = ('_permissions',)
+
+    hashed_attributes = Node.hashed_attributes + ('permissions',)
+    permissions = tracked_attribute('permissions')
+    batch_permissions = True
 
     def __init__(self, *args, **kwargs):
-        self.permissions = kwargs.pop('permissions')
+        self._permissions = kwargs.pop('permissions')
         super(AnyPermissionsNode, self).__init__(*args, **kwargs)
 
     def is_viewable_by(self, user, context={}):
+        has_perm = get_permission_checker(self, user, context)
         for permission in self.permissions:
-            has_perm = user.has_perm(permission)
-            if has_perm:
+            if has_perm(permission):
                 return True
         return False
 
 
 class PassTestNode(Node):
+    __slots__ = ('_test', 'cache_visibility')
+
+    hashed_attributes = Node.hashed_attributes + ('test',)
+    test = tracked_attribute('test')
+
     def __init__(self, *args, **kwargs):
-        self.test = kwargs.pop('test')
+        self._test = kwargs.pop('test')
+        # set cacheable=False if the test result may change during a rendering
+        self.cache_visibility = kwargs.pop('cacheable', True)
         super(PassTestNode, self).__init__(*args, **kwargs)
 
     def is_viewable_by(self, user, context={}):
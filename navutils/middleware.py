@@ -0,0 +1,18 @@
+from . import menu
+
+
+class CurrentMenuItemMiddleware(object):
+    """
+    Set ``request.current_menu_item`` to the id of the node matching the
+    requested URL (see :py:meth:`navutils.menu.Menus.match_request`). Menus
+    rendered without a ``current_menu_item`` fall back to it.
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        return self.get_response(request)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        # request.resolver_match is only set once the URL is resolved
+        request.current_menu_item = menu.registry.match_request(request)
@@ -0,0 +1,39 @@
+"""
+A panel for django-debug-toolbar, listing the menus and breadcrumbs rendered
+during a request. Add it to your settings::
+
+    DEBUG_TOOLBAR_PANELS = [
+        # ...
+        'navutils.panels.NavutilsPanel',
+    ]
+"""
+from debug_toolbar.panels import Panel
+
+from . import instrumentation
+
+
+class NavutilsPanel(Panel):
+    title = 'Navutils'
+    template = 'navutils/debug_toolbar.html'
+
+    @property
+    def nav_subtitle(self):
+        stats = self.get_stats()
+        if not stats:
+            return ''
+        return '{0} renderings in {1:.2f}ms'.format(len(stats['renderings']), stats['duration'])
+
+    def enable_instrumentation(self):
+        instrumentation.enable()
+
+    def disable_instrumentation(self):
+        # back to what the INSTRUMENTATION setting says
+        instrumentation.configure()
+
+    def process_request(self, request):
+        self.records = []
+        with instrumentation.collect(self.records, detailed=True):
+            return super(NavutilsPanel, self).process_request(request)
+
+    def generate_stats(self, request, response):
+        self.record_stats(instrumentation.summarize(getattr(self, 'records', [])))
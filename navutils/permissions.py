@@ -0,0 +1,77 @@
+from django.contrib import auth
+from django.utils.module_loading import import_string
+
+from .state import get_render_state
+
+
+class PermissionSet(object):
+    """
+    All the permissions of a user, fetched at once
+    """
+    def __init__(self, user, permissions):
+        self.user = user
+        self.is_superuser = bool(user.is_active and user.is_superuser)
+        self.permissions = frozenset(permissions)
+
+    def has_perm(self, permission):
+        # same as django's PermissionsMixin.has_perm
+        return self.is_superuser or permission in self.permissions
+
+
+def can_batch_backend(backend):
+    """
+    A backend can be batched if it doesn't grant permissions, or if its
+    ``get_all_permissions`` returns everything ``has_perm`` may accept.
+    Backends can opt out by setting ``navutils_batch_permissions = False``.
+    """
+    if not hasattr(backend, 'has_perm'):
+        return True
+    if not hasattr(backend, 'get_all_permissions'):
+        return False
+    return getattr(backend, 'navutils_batch_permissions', True)
+
+
+def get_all_permissions(user):
+    """
+    The default ``PERMISSIONS_PROVIDER``
+
+    :return: the permissions of the user, or ``None`` if they cannot be
+    fetched in bulk
+    """
+    if not hasattr(user, 'get_all_permissions'):
+        return None
+    if not all(can_batch_backend(backend) for backend in auth.get_backends()):
+        return None
+    return user.get_all_permissions()
+
+
+def get_permission_set(user):
+    """
+    :return: a :py:class:`PermissionSet` for the given user, or ``None`` if
+    permissions must be checked one by one with ``user.has_perm``
+    """
+    from . import settings
+
+    config = settings.NAVUTILS_MENU_CONFIG
+    if not config['BATCH_PERMISSIONS']:
+        return None
+    provider = config['PERMISSIONS_PROVIDER']
+    if isinstance(provider, str):
+        provider = import_string(provider)
+    permissions = provider(user)
+    if permissions is None:
+        return None
+    return PermissionSet(user, permissions)
+
+
+def get_permission_checker(node, user, context):
+    """
+    :return: a callable that takes a permission name and tells if the user
+    has it. Permissions are fetched once per rendering when possible.
+    """
+    state = get_render_state(context)
+    if state is not None and getattr(node, 'batch_permissions', False):
+        permission_set = state.get_permissions(user)
+        if permission_set is not None:
+            return permission_set.has_perm
+    return user.has_perm
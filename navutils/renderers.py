@@ -0,0 +1,337 @@
+from django.template import Context
+from django.template.context import BaseContext
+from django.utils.safestring import mark_safe
+
+from navutils import instrumentation, settings
+from navutils.menu import get_current_lineage
+from navutils.state import get_children_getter, get_render_state, is_viewable
+
+DEFAULT_MENU_TEMPLATE = 'navutils/menu.html'
+DEFAULT_NODE_TEMPLATE = 'navutils/node.html'
+
+
+def use_native_renderer(menu):
+    """
+    Return ``True`` if the given menu should be rendered without going
+    through the template engine
+    """
+    if menu.template != DEFAULT_MENU_TEMPLATE:
+        return False
+    native = getattr(menu, 'native', None)
+    if native is None:
+        return settings.NAVUTILS_MENU_CONFIG['NATIVE_RENDERER']
+    return native
+
+
+class NativeRenderer(object):
+    """
+    Build the same HTML as ``navutils/menu.html`` and ``navutils/node.html``
+    by walking the menu tree in Python. Nodes using a custom template are
+    still rendered through the template engine.
+    """
+    def __init__(self, context, user, current_menu_item=None, max_depth=999):
+        # avoid circular imports, the template tags rely on this module
+        from navutils.templatetags import navutils_tags
+
+        self.render_nested = navutils_tags.render_nested
+        self.markers = navutils_tags.TEMPLATE_MARKERS
+        self.render_template_node = navutils_tags.render_node
+        if not isinstance(context, BaseContext):
+            context = Context(context)
+        self.context = context
+        self.state = get_render_state(context)
+        self.get_children = get_children_getter(context)
+        self.user = user
+        self.current_menu_item = current_menu_item
+        self.lineage = None
+        self.max_depth = max_depth
+        self.menu_config = settings.NAVUTILS_MENU_CONFIG
+
+    def nested(self, value, node_context=None):
+        """
+        Render a value that may contain template markup, the same way
+        ``{% render_nested %}`` does in the default templates.
+
+        :param node_context: the variables available in ``navutils/node.html``,
+        or a callable returning them
+        """
+        text = str(value)
+        if not any(marker in text for marker in self.markers):
+            return text
+        if node_context is None:
+            return self.render_nested(self.context, text)
+        if callable(node_context):
+            node_context = node_context()
+
+        with self.context.push(node_context['node'].get_context(node_context)):
+            return self.render_nested(self.context, text)
+
+    def render_menu(self, menu, viewable_nodes):
+        return mark_safe(''.join(self.iter_menu(menu, viewable_nodes)))
+
+    def iter_menu(self, menu, viewable_nodes):
+        """
+        Same as :py:meth:`render_menu`, but yield the HTML of the menu node by
+        node instead of building it at once. The menu variables stay pushed on
+        the context of the renderer until the generator is exhausted.
+        """
+        compiled = menu.compile()
+        # hidden top-level nodes are not searched, so their dynamic children
+        # are not generated, as in RenderState.aresolve()
+        self.lineage = compiled.get_current_lineage(
+            self.current_menu_item, self.get_children, viewable_roots=viewable_nodes)
+        values = {
+            'menu': menu,
+            'viewable_nodes': viewable_nodes,
+            'user': self.user,
+            'max_depth': self.max_depth,
+            'current_menu_item': self.current_menu_item,
+            'current_menu_lineage': self.lineage,
+            'menu_config': self.menu_config,
+        }
+        with self.context.push(menu.get_context(values)):
+            css_class = self.nested(menu.id) + '-menu'
+            if menu.css_class:
+                css_class += ' ' + self.nested(menu.css_class)
+
+            yield '<ul class="' + css_class + '">'
+            for part in self.iter_compiled(compiled, viewable_nodes):
+                yield part
+            yield '</ul>'
+
+    def get_visibility(self, compiled, viewable_nodes):
+        """
+        Walk the compiled menu once, skipping the subtrees of hidden nodes
+        and nodes that are too deep.
+
+        :return: a tuple of lists, indexed like the compiled menu: visible
+        nodes, nodes with visible children, and nodes with a visible child
+        leading to the current node
+        """
+        size = len(compiled)
+        visible = [False] * size
+        has_children = [False] * size
+        has_current = [False] * size
+        # top-level nodes were already checked by the render_menu tag
+        viewable_roots = set(map(id, viewable_nodes))
+        nodes, depths, parents, ends = compiled.nodes, compiled.depths, compiled.parents, compiled.ends
+        index = 0
+        while index < size:
+            depth = depths[index]
+            if depth == 0:
+                viewable = id(nodes[index]) in viewable_roots
+            else:
+                viewable = depth <= self.max_depth and self.is_viewable(compiled, index)
+            if not viewable:
+                index = ends[index]
+                continue
+
+            visible[index] = True
+            parent = parents[index]
+            if parent != -1:
+                has_children[parent] = True
+                if compiled.ids[index] in self.lineage:
+                    has_current[parent] = True
+            if nodes[index].template != DEFAULT_NODE_TEMPLATE:
+                # rendered through its template, with its own subtree
+                index = ends[index]
+            else:
+                index += 1
+        return visible, has_children, has_current
+
+    def is_viewable(self, compiled, index):
+        if self.state is None:
+            return compiled.predicates[index](self.user, self.context)
+        return self.state.is_viewable(compiled.nodes[index], self.user, self.context)
+
+    def render_compiled(self, compiled, viewable_nodes):
+        return list(self.iter_compiled(compiled, viewable_nodes))
+
+    def iter_compiled(self, compiled, viewable_nodes):
+        """
+        Yield the HTML of each visible node, up to its children, then its
+        closing tags once its subtree is done
+        """
+        visible, has_children, has_current = self.get_visibility(compiled, viewable_nodes)
+        nodes, depths, ends = compiled.nodes, compiled.depths, compiled.ends
+        # nodes whose closing tags are still to be written
+        opened = []
+        size = len(compiled)
+        index = 0
+        while index < size:
+            if not visible[index]:
+                index = ends[index]
+                continue
+            while opened and ends[opened[-1]] <= index:
+                yield self.close_node(has_children[opened.pop()])
+
+            node = nodes[index]
+            if node.template != DEFAULT_NODE_TEMPLATE or compiled.dynamic[index]:
+                for part in self.iter_node(node, start_depth=0, current_depth=depths[index]):
+                    yield part
+                index = ends[index]
+                continue
+
+            url = compiled.urls[index]
+            yield ''.join(self.open_node(
+                node,
+                url=node.get_url() if url is None and not node.is_divider else url,
+                is_current=node.is_current(self.current_menu_item),
+                has_current=has_current[index],
+                has_children=has_children[index],
+                node_context=self.get_compiled_node_context(compiled, index, visible, has_current[index]),
+            ))
+            opened.append(index)
+            index += 1
+
+        while opened:
+            yield self.close_node(has_children[opened.pop()])
+
+    def get_compiled_node_context(self, compiled, index, visible, has_current):
+        def get_node_context():
+            node = compiled.nodes[index]
+            children = [
+                compiled.nodes[i] for i in range(index + 1, compiled.ends[index])
+                if visible[i] and compiled.parents[i] == index
+            ]
+            return self.get_node_context(
+                node,
+                is_current=node.is_current(self.current_menu_item),
+                has_current=has_current,
+                viewable_children=children,
+                start_depth=0,
+                current_depth=compiled.depths[index],
+            )
+        return get_node_context
+
+    def get_node_context(self, node, is_current, has_current, viewable_children,
+                         start_depth, current_depth):
+        return {
+            'is_current': is_current,
+            'has_current': has_current,
+            'current_menu_item': self.current_menu_item,
+            'current_menu_lineage': self.lineage,
+            'node': node,
+            'viewable_children': viewable_children,
+            'user': self.user,
+            'max_depth': self.max_depth,
+            'current_depth': current_depth,
+            'start_depth': start_depth,
+            'menu_config': self.menu_config,
+        }
+
+    def render_node(self, node, start_depth, current_depth):
+        """
+        Render a node and its subtree recursively, used for nodes with
+        dynamic children or a custom template
+        """
+        return ''.join(self.iter_node(node, start_depth, current_depth))
+
+    def iter_node(self, node, start_depth, current_depth):
+        """
+        Same as :py:meth:`render_node`, yielding the HTML of each node of the
+        subtree. Nodes with a custom template are rendered at once.
+        """
+        if node.template != DEFAULT_NODE_TEMPLATE:
+            yield self.render_template_node(
+                self.context,
+                node,
+                user=self.user,
+                current_menu_item=self.current_menu_item,
+                current_menu_lineage=self.lineage,
+                max_depth=self.max_depth,
+                start_depth=start_depth,
+                current_depth=current_depth,
+            )
+            return
+
+        viewable_children = []
+        if current_depth + 1 <= self.max_depth:
+            viewable_children = [
+                child for child in self.get_children(node)
+                if is_viewable(child, self.user, self.context)
+            ]
+
+        if self.lineage is None:
+            self.lineage = get_current_lineage([node], self.current_menu_item, self.get_children)
+        is_current = node.is_current(self.current_menu_item)
+        has_current = node.has_current(self.current_menu_item, viewable_children, self.lineage)
+        node_context = self.get_node_context(
+            node,
+            is_current=is_current,
+            has_current=has_current,
+            viewable_children=viewable_children,
+            start_depth=start_depth,
+            current_depth=current_depth,
+        )
+
+        yield ''.join(self.open_node(
+            node,
+            url=None if node.is_divider else node.get_url(),
+            is_current=is_current,
+            has_current=has_current,
+            has_children=bool(viewable_children),
+            node_context=node_context,
+        ))
+        for child in viewable_children:
+            for part in self.iter_node(child, start_depth, current_depth + 1):
+                yield part
+        yield self.close_node(bool(viewable_children))
+
+    def open_node(self, node, url, is_current, has_current, has_children, node_context):
+        """
+        :return: the HTML of the node, up to its children, as a list of strings
+        """
+        if instrumentation.enabled:
+            instrumentation.count('nodes_rendered')
+        classes = ['menu-item']
+        if node.css_class:
+            classes.append(self.nested(node.css_class, node_context))
+        if is_current:
+            classes.append(self.nested(self.menu_config['CURRENT_MENU_ITEM_CLASS'], node_context))
+        if has_current:
+            classes.append(self.nested(self.menu_config['CURRENT_MENU_ITEM_PARENT_CLASS'], node_context))
+        if has_children:
+            classes.append('has-children has-dropdown')
+
+        parts = ['<li class="', ' '.join(classes), '"']
+        for attr, value in node.attrs.items():
+            parts += [' ', self.nested(attr, node_context), '="', self.nested(value, node_context), '"']
+        parts.append('>')
+
+        if not node.is_divider:
+            parts += ['<a href="', self.nested(url, node_context), '"']
+            for attr, value in node.link_attrs.items():
+                parts += [' ', self.nested(attr, node_context), '="', self.nested(value, node_context), '"']
+            parts.append('>')
+        parts.append(self.nested(node.label, node_context))
+        if not node.is_divider:
+            parts.append('</a>')
+
+        if has_children:
+            submenu_class = 'sub-menu dropdown'
+            if getattr(node, 'submenu_css_class', None):
+                submenu_class += ' ' + self.nested(node.submenu_css_class, node_context)
+            parts += ['<ul class="', submenu_class, '">']
+        return parts
+
+    def close_node(self, has_children):
+        return '</ul></li>' if has_children else '</li>'
+
+
+def buffer_chunks(parts, chunk_size):
+    """
+    Join the given strings into chunks of at least ``chunk_size`` characters
+    (but the last one), so streamed responses are not written a tag at a time
+    """
+    buffer = []
+    size = 0
+    for part in parts:
+        buffer.append(part)
+        size += len(part)
+        if size >= chunk_size:
+            yield ''.join(buffer)
+            buffer = []
+            size = 0
+    if buffer:
+        yield ''.join(buffer)
@@ -0,0 +1,131 @@
+"""
+Export menus as JSON serializable trees, for client-side rendering.
+"""
+import hashlib
+
+from django.template import Context
+from django.template.context import BaseContext
+
+from navutils.cache import get_url_context
+from navutils.state import get_children_getter, get_render_state, is_viewable
+
+
+class MenuSerializer(object):
+    """
+    Turn a menu into nested dicts, holding only the nodes the user can see.
+    Labels, URLs, CSS classes and attributes may contain template markup: they
+    are rendered the same way ``{% render_nested %}`` does in the default
+    templates.
+    """
+    def __init__(self, context, user, max_depth=999):
+        # avoid circular imports, the template tags rely on the menu module
+        from navutils.templatetags import navutils_tags
+
+        self.render_nested = navutils_tags.render_nested
+        self.markers = navutils_tags.TEMPLATE_MARKERS
+        if not isinstance(context, BaseContext):
+            context = Context(context)
+        self.context = context
+        get_render_state(context, create=True)
+        self.get_children = get_children_getter(context)
+        self.user = user
+        self.max_depth = max_depth
+
+    def get_tree(self, menu):
+        """
+        :return: a list of ``(node, children, dynamic)`` tuples for the visible
+        top-level nodes, where ``children`` is a list of such tuples and
+        ``dynamic`` tells if the node was returned by a ``children`` callable
+        """
+        def build(node, depth, dynamic):
+            children = []
+            if depth + 1 <= self.max_depth:
+                children_dynamic = dynamic or hasattr(node._children, '__call__')
+                children = [
+                    build(child, depth + 1, children_dynamic)
+                    for child in self.get_children(node)
+                    if is_viewable(child, self.user, self.context)
+                ]
+            return (node, children, dynamic)
+
+        roots = sorted(menu.values(), key=lambda i: i.weight, reverse=True)
+        return [build(node, 0, False) for node in roots if is_viewable(node, self.user, self.context)]
+
+    def get_etag(self, menu, tree=None):
+        """
+        :return: a hash of the menu structure and of the nodes visible in
+        ``tree``. Dynamic children are not part of the menu structure, so
+        their fingerprint is included.
+        """
+        if tree is None:
+            tree = self.get_tree(menu)
+        digest = hashlib.sha1(menu.get_structure_hash().encode('utf-8'))
+        digest.update(repr((get_url_context(), self.max_depth)).encode('utf-8'))
+
+        def update(entries):
+            for node, children, dynamic in entries:
+                digest.update((node.get_fingerprint() if dynamic else str(node.id)).encode('utf-8'))
+                update(children)
+                # mark the end of the children, so moving a node changes the hash
+                digest.update(b'/')
+
+        update(tree)
+        return digest.hexdigest()
+
+    def nested(self, value, node):
+        text = str(value)
+        if not any(marker in text for marker in self.markers):
+            return text
+        values = {'node': node, 'user': self.user, 'max_depth': self.max_depth}
+        with self.context.push(node.get_context(values)):
+            return str(self.render_nested(self.context, text))
+
+    def serialize(self, menu, tree=None):
+        """
+        :return: a dict with the menu ``id``, ``css_class`` (if any) and its
+        visible ``nodes``
+        """
+        if tree is None:
+            tree = self.get_tree(menu)
+        data = {'id': menu.id}
+        if menu.css_class:
+            data['css_class'] = str(menu.css_class)
+        data['nodes'] = [self.serialize_node(node, children) for node, children, dynamic in tree]
+        return data
+
+    def serialize_node(self, node, children):
+        """
+        :return: a dict describing the node. Keys whose value would be empty
+        are left out, to keep the output compact.
+        """
+        data = {
+            'id': node.id,
+            'label': self.nested(node.label, node),
+        }
+        if node.is_divider:
+            data['divider'] = True
+        else:
+            data['url'] = self.nested(node.get_url(), node)
+        if node.css_class:
+            data['css_class'] = self.nested(node.css_class, node)
+        if node.attrs:
+            data['attrs'] = {
+                self.nested(key, node): self.nested(value, node) for key, value in node.attrs.items()
+            }
+        if node.link_attrs:
+            data['link_attrs'] = {
+                self.nested(key, node): self.nested(value, node) for key, value in node.link_attrs.items()
+            }
+        if children:
+            data['children'] = [
+                self.serialize_node(child, grandchildren) for child, grandchildren, dynamic in children
+            ]
+        return data
+
+
+def serialize_menu(menu, user, context=None, max_depth=999):
+    """
+    :return: the nodes of ``menu`` visible by ``user``, as nested dicts, see
+    :py:class:`MenuSerializer`
+    """
+    return MenuSerializer(context or {}, user, max_depth=max_depth).serialize(menu)
@@ -4,6 +4,30 @@ from django.conf import settings
 DEFAULT_MENU_CONFIG = {
     'CURRENT_MENU_ITEM_CLASS': 'current',
     'CURRENT_MENU_ITEM_PARENT_CLASS': 'has-current',
+    # how many compiled templates render_nested will keep around
+    'RENDER_NESTED_CACHE_SIZE': 512,
+    # render menus in Python instead of through navutils/menu.html and navutils/node.html
+    'NATIVE_RENDERER': False,
+    # alias of the django cache used to store rendered menus, None to disable
+    'FRAGMENT_CACHE': None,
+    'FRAGMENT_CACHE_TIMEOUT': 300,
+    # how many reversed URLs are kept in memory by each process
+    'REVERSE_CACHE_SIZE': 1024,
+    # reverse the URL of static nodes as soon as they are registered in a menu
+    'PRELOAD_URLS': False,
+    # fetch the permissions of the user once per rendering, instead of
+    # calling user.has_perm for each permission of each node
+    'BATCH_PERMISSIONS': True,
+    # a callable (or its dotted path) returning all the permissions of a user,
+    # or None if they cannot be fetched at once
+    'PERMISSIONS_PROVIDER': 'navutils.permissions.get_all_permissions',
+    # record renderings, see navutils.instrumentation
+    'INSTRUMENTATION': False,
+    # import the menu module of each app on first access to the menu registry,
+    # instead of at startup
+    'LAZY_AUTODISCOVERY': False,
+    # minimum size of the chunks yielded by stream_menu, in characters
+    'STREAM_CHUNK_SIZE': 8192,
 }
 
 existing_conf = getattr(settings, 'NAVUTILS_MENU_CONFIG', {})
@@ -0,0 +1,231 @@
+import asyncio
+import inspect
+import time
+
+from . import instrumentation
+
+
+class RenderState(object):
+    """
+    Data shared by all the nodes rendered for a given page, so expensive
+    computations happen only once. It is stored in the template context,
+    under :py:data:`CONTEXT_KEY`.
+    """
+    def __init__(self):
+        # id(user) -> (user, PermissionSet or None)
+        self._permissions = {}
+        # (node, id(user)) -> bool
+        self._visibility = {}
+        # keep a reference to users, so their ids are not reused
+        self._users = {}
+        # node -> children returned by its callable
+        self._children = {}
+        # how many times is_viewable_by was called, or avoided
+        self.evaluations = 0
+        self.saved_evaluations = 0
+        # True once visibility and children were resolved by aresolve()
+        self.resolved = False
+
+    def is_viewable(self, node, user, context):
+        """
+        Call ``node.is_viewable_by`` once per node and user, unless the node
+        sets ``cache_visibility`` to ``False``
+        """
+        if not node.cache_visibility and not self.resolved:
+            self.evaluations += 1
+            return check_visibility(node, user, context)
+
+        key = (node, id(user))
+        try:
+            viewable = self._visibility[key]
+        except KeyError:
+            self.evaluations += 1
+            viewable = self._visibility[key] = check_visibility(node, user, context)
+            self._users[id(user)] = user
+        else:
+            self.saved_evaluations += 1
+        return viewable
+
+    def get_permissions(self, user):
+        """
+        :return: the :py:class:`navutils.permissions.PermissionSet` of the
+        given user, or ``None`` if permissions cannot be fetched in bulk
+        """
+        try:
+            return self._permissions[id(user)][1]
+        except KeyError:
+            pass
+        from navutils import permissions
+
+        permission_set = permissions.get_permission_set(user)
+        self._permissions[id(user)] = (user, permission_set)
+        return permission_set
+
+    def get_children(self, node):
+        """
+        Same as ``node.children``, but dynamic children are only generated
+        once per rendering
+        """
+        if not hasattr(node._children, '__call__'):
+            return node._children
+        try:
+            return self._children[node]
+        except KeyError:
+            children = self._children[node] = list(node.children)
+            return children
+
+    async def aresolve(self, nodes, user, context, max_depth=999):
+        """
+        Check the visibility of the given nodes and their descendants, and
+        generate their dynamic children, before rendering them. Predicates and
+        children callables may be sync or async: sync ones are called for a
+        whole tree level at once, in a single thread, and async ones are
+        awaited concurrently. Children are only generated for nodes that are
+        visible, or below the root. Rendering then only reads the results, and can
+        run in the event loop.
+
+        Nodes that are not cacheable are only checked once, too.
+        """
+        from asgiref.sync import sync_to_async
+
+        self._users[id(user)] = user
+        # (node, depth, whether its visibility is needed)
+        level = [(node, 0, True) for node in nodes]
+        while level:
+            checked = [
+                node for node, depth, check in level
+                if check and depth <= max_depth and (node, id(user)) not in self._visibility
+            ]
+            if checked:
+                visibility = await sync_to_async(
+                    lambda: [node.is_viewable_by(user, context) for node in checked])()
+                visibility = await gather(visibility)
+            else:
+                visibility = []
+            self.evaluations += len(checked)
+            for node, viewable in zip(checked, visibility):
+                self._visibility[(node, id(user))] = viewable
+            if instrumentation.enabled:
+                # checks ran concurrently, their own cost is unknown
+                for node, viewable in zip(checked, visibility):
+                    instrumentation.visibility_checked(node, viewable, None)
+
+            # the children of hidden nodes are still needed to find the current
+            # node, except at the root, as when rendering synchronously
+            expanded = []
+            for node, depth, check in level:
+                viewable = check and depth <= max_depth and self._visibility[(node, id(user))]
+                if depth > 0 or viewable:
+                    expanded.append((node, depth, viewable))
+
+            dynamic = [
+                node for node, depth, viewable in expanded
+                if hasattr(node._children, '__call__') and node not in self._children
+            ]
+
+            def call():
+                children = []
+                for node in dynamic:
+                    cached = node.get_children_cache()
+                    children.append(node.generate_children() if cached is None else cached)
+                return children
+
+            if dynamic:
+                children = await gather(await sync_to_async(call)())
+            else:
+                children = []
+            for node, node_children in zip(dynamic, children):
+                node_children = self._children[node] = list(node_children)
+                if node.caches_children and node.get_children_cache() is None:
+                    node.set_children_cache(node_children)
+
+            level = [
+                (child, depth + 1, viewable)
+                for node, depth, viewable in expanded
+                for child in self.get_children(node)
+            ]
+        self.resolved = True
+
+
+async def gather(values):
+    """
+    :return: the given values, with awaitable ones replaced by their result,
+    awaited concurrently
+    """
+    values = list(values)
+    pending = [index for index, value in enumerate(values) if inspect.isawaitable(value)]
+    results = await asyncio.gather(*(values[index] for index in pending))
+    for index, result in zip(pending, results):
+        values[index] = result
+    return values
+
+
+def resolve(value):
+    """
+    :return: the given value, or its result if it is awaitable, so async
+    predicates and children also work during sync renderings
+    """
+    if not inspect.isawaitable(value):
+        return value
+    from asgiref.sync import async_to_sync
+
+    async def wait():
+        return await value
+    return async_to_sync(wait)()
+
+
+CONTEXT_KEY = 'navutils_render_state'
+
+
+def get_render_state(context, create=False):
+    """
+    :return: the :py:class:`RenderState` stored in the given context. If
+    ``create`` is true, a new one is stored in the context if needed,
+    otherwise ``None`` is returned.
+    """
+    if context is None:
+        return None
+    state = context.get(CONTEXT_KEY)
+    if state is None and create:
+        state = RenderState()
+        context[CONTEXT_KEY] = state
+    return state
+
+
+def is_viewable(node, user, context):
+    """
+    Check if the node is viewable by the user, through the
+    :py:class:`RenderState` of the context if there is one
+    """
+    state = get_render_state(context)
+    if state is None:
+        return check_visibility(node, user, context)
+    return state.is_viewable(node, user, context)
+
+
+def check_visibility(node, user, context):
+    """
+    Call ``node.is_viewable_by``, waiting for its result if needed
+    """
+    if not instrumentation.enabled:
+        return resolve(node.is_viewable_by(user, context))
+
+    start = time.perf_counter()
+    viewable = resolve(node.is_viewable_by(user, context))
+    instrumentation.visibility_checked(node, viewable, time.perf_counter() - start)
+    return viewable
+
+
+def get_children_getter(context):
+    """
+    :return: a callable returning the children of a node, through the
+    :py:class:`RenderState` of the context if there is one
+    """
+    state = get_render_state(context)
+    if state is None:
+        return get_children
+    return state.get_children
+
+
+def get_children(node):
+    return node.children
@@ -1,10 +1,103 @@
+import copy
+import os
+import time
+
+import django
 from django import template
-from navutils import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.template.context import BaseContext
+from django.utils.functional import LazyObject
+from django.utils.safestring import mark_safe
+
+from navutils import instrumentation, renderers, settings
+from navutils.cache import LRUCache, get_fragment_cache
+from navutils.menu import get_current_lineage
+from navutils.state import get_children_getter, get_render_state, is_viewable
 
 register = template.Library()
 
+# compiled render_nested templates, keyed by (engine, source)
+nested_templates = LRUCache(settings.NAVUTILS_MENU_CONFIG['RENDER_NESTED_CACHE_SIZE'])
+
+TEMPLATE_MARKERS = ('{%', '{{', '{#')
+
+try:
+    # Django 2.2+
+    from django.utils.autoreload import file_changed
+except ImportError:
+    file_changed = None
+
+if django.VERSION >= (1, 8):
+    def load_template(template_name):
+        # the loader returns a backend wrapper that only accepts dicts, and
+        # flattens them into a new context. The wrapped template renders our
+        # context as is.
+        return template.loader.get_template(template_name).template
+else:
+    load_template = template.loader.get_template
+
+# menu, node and crumb templates, keyed by name
+resolved_templates = {}
+
+
+def get_template(template_name):
+    """
+    Same as ``get_template``, but go through the template loaders only once
+    per template name, even without the cached loader. Templates are loaded
+    again when a file or the template settings change.
+    """
+    try:
+        t = resolved_templates[template_name]
+    except KeyError:
+        if instrumentation.enabled:
+            instrumentation.count('template_loads')
+        t = resolved_templates[template_name] = load_template(template_name)
+        return t
+    if instrumentation.enabled:
+        instrumentation.count('template_cache_hits')
+    return t
+
+
+def is_bundled_template(template_name):
+    """
+    :return: ``True`` if ``template_name`` resolves to the template shipped
+    with navutils, ``False`` if the project overrides it
+    """
+    bundled = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'templates', template_name)
+    origin = getattr(get_template(template_name), 'origin', None)
+    return origin is not None and os.path.normpath(str(origin.name)) == os.path.normpath(bundled)
+
+
+def clear_resolved_templates(**kwargs):
+    resolved_templates.clear()
+
+
+@receiver(setting_changed)
+def reset_resolved_templates(setting, **kwargs):
+    if setting in ('TEMPLATES', 'INSTALLED_APPS'):
+        clear_resolved_templates()
+
+
+if file_changed is not None:
+    # the development server reloads templates without restarting
+    file_changed.connect(clear_resolved_templates, dispatch_uid='navutils.templates')
+
+
+def render_template(template_name, context, values):
+    """
+    Render a template with the given values on top of the page context. They
+    are removed once the template is rendered, so sibling nodes don't see each
+    other's values and the context does not grow with the number of nodes.
+    """
+    if not isinstance(context, BaseContext):
+        context = template.Context(context)
+    with context.push(values):
+        return get_template(template_name).render(context)
+
 
 @register.simple_tag(takes_context=True)
+@instrumentation.instrument('menu', lambda context, menu, **kwargs: menu.id)
 def render_menu(context, menu, **kwargs):
 
     # menu = kwargs.get('menu', context.get('menu'))
@@ -15,8 +108,9 @@ def render_menu(context, menu, **kwargs):
     if not user:
         raise ValueError('missing user parameter')
 
+    get_render_state(context, create=True)
     max_depth = kwargs.get('max_depth', context.get('max_depth', 999))
-    viewable_nodes = [node for node in menu.values() if node.is_viewable_by(user, context)]
+    viewable_nodes = [node for node in menu.values() if is_viewable(node, user, context)]
     
     # Also sort parent nodes if them have weight
     viewable_nodes = sorted(viewable_nodes,key=lambda i: i.weight, reverse=True)
@@ -24,24 +118,150 @@ def render_menu(context, menu, **kwargs):
     if not viewable_nodes:
         return ''
 
-    t = template.loader.get_template(menu.template)
+    current_menu_item = get_current_menu_item(context, kwargs)
+    fragment_cache = get_fragment_cache(menu)
+    if fragment_cache is None:
+        return _render_menu(context, menu, user, viewable_nodes, current_menu_item, max_depth)
+
+    key = fragment_cache.get_key(menu, user, context, current_menu_item, max_depth)
+    output = fragment_cache.get(key)
+    if instrumentation.enabled:
+        instrumentation.count('fragment_cache_misses' if output is None else 'fragment_cache_hits')
+    if output is None:
+        output = _render_menu(context, menu, user, viewable_nodes, current_menu_item, max_depth)
+        fragment_cache.set(key, output)
+    return mark_safe(output)
+
+
+async def arender_menu(context, menu, **kwargs):
+    """
+    Same as :py:func:`render_menu`, for async code. Node visibility and dynamic
+    children, sync or async, are resolved ahead of rendering (see
+    :py:meth:`navutils.state.RenderState.aresolve`), so the rendering itself
+    does not block the event loop on database queries.
+    """
+    user = kwargs.get('user', context.get('user', getattr(context.get('request', object()), 'user', None)))
+    if isinstance(user, LazyObject):
+        # request.user, loading it may query the database
+        from asgiref.sync import sync_to_async
+        user_loaded = await sync_to_async(bool)(user)
+    else:
+        user_loaded = bool(user)
+    if not user_loaded:
+        raise ValueError('missing user parameter')
+
+    state = get_render_state(context, create=True)
+    max_depth = kwargs.get('max_depth', context.get('max_depth', 999))
+    await state.aresolve(menu.values(), user, context, max_depth)
+    return render_menu(context, menu, **kwargs)
+
+
+def get_current_menu_item(context, kwargs):
+    current_menu_item = kwargs.get('current_menu_item', context.get('current_menu_item'))
+    if current_menu_item is None:
+        # set by CurrentMenuItemMiddleware
+        current_menu_item = getattr(context.get('request'), 'current_menu_item', None)
+    return current_menu_item
+
+
+def stream_menu(context, menu, **kwargs):
+    """
+    Same as :py:func:`render_menu`, but return an iterator over the HTML of
+    the menu, for ``StreamingHttpResponse`` or streamed templates. Menus using
+    the native renderer are rendered node by node, so only the current branch
+    of the tree and a chunk of output are held in memory at once. Other menus
+    using the default template are rendered one top-level node at a time,
+    through the node templates.
+
+    Chunks are about ``chunk_size`` characters long, default to the
+    ``STREAM_CHUNK_SIZE`` setting. Streamed menus are read from the fragment
+    cache, but not stored in it, since that would need the whole output.
+    """
+    user = kwargs.get('user', context.get('user', getattr(context.get('request', object()), 'user', None)))
+    if not user:
+        raise ValueError('missing user parameter')
+
+    if not isinstance(context, BaseContext):
+        context = template.Context(context)
+    get_render_state(context, create=True)
+    max_depth = kwargs.get('max_depth', context.get('max_depth', 999))
+    viewable_nodes = [node for node in menu.values() if is_viewable(node, user, context)]
+    viewable_nodes = sorted(viewable_nodes, key=lambda i: i.weight, reverse=True)
+    if not viewable_nodes:
+        return iter(())
+
+    current_menu_item = get_current_menu_item(context, kwargs)
+    fragment_cache = get_fragment_cache(menu)
+    if fragment_cache is not None:
+        output = fragment_cache.get(fragment_cache.get_key(menu, user, context, current_menu_item, max_depth))
+        if output is not None:
+            return iter((mark_safe(output),))
+
+    native = renderers.use_native_renderer(menu)
+    if menu.template != renderers.DEFAULT_MENU_TEMPLATE or (
+            not native and not is_bundled_template(renderers.DEFAULT_MENU_TEMPLATE)):
+        # a custom menu template cannot be split
+        return iter((_render_menu(context, menu, user, viewable_nodes, current_menu_item, max_depth),))
+
+    # the menu variables stay pushed until the stream ends, on a copy of the
+    # context, so the caller can use and push onto its own meanwhile
+    context = copy.copy(context)
+    if native:
+        renderer = renderers.NativeRenderer(
+            context, user, current_menu_item=current_menu_item, max_depth=max_depth)
+        parts = renderer.iter_menu(menu, viewable_nodes)
+    else:
+        parts = _iter_menu(context, menu, user, viewable_nodes, current_menu_item, max_depth)
+    chunk_size = kwargs.get('chunk_size', settings.NAVUTILS_MENU_CONFIG['STREAM_CHUNK_SIZE'])
+    chunks = renderers.buffer_chunks(parts, chunk_size)
+    return (mark_safe(chunk) for chunk in chunks)
+
+
+def _iter_menu(context, menu, user, viewable_nodes, current_menu_item, max_depth):
+    """
+    Yield the same HTML as ``navutils/menu.html``, one top-level node at a
+    time, each one rendered through its template
+    """
     c = {
         'menu': menu,
         'viewable_nodes': viewable_nodes,
         'user': user,
         'max_depth': max_depth,
-        'current_menu_item': kwargs.get('current_menu_item', context.get('current_menu_item')),
+        'current_menu_item': current_menu_item,
+        'current_menu_lineage': get_current_lineage(
+            viewable_nodes, current_menu_item, get_children_getter(context)),
         'menu_config': settings.NAVUTILS_MENU_CONFIG
     }
-    context.update(c)
-    final_context = menu.get_context(context)
-    try:
-        return t.render(final_context)
-    except TypeError:
-        # Django 2.0+
-        return t.render(final_context.flatten())
+    with context.push(menu.get_context(c)):
+        css_class = render_nested(context, menu.id) + '-menu'
+        if menu.css_class:
+            css_class += ' ' + render_nested(context, menu.css_class)
+        yield '<ul class="' + css_class + '">'
+        for node in viewable_nodes:
+            yield render_node(context, node=node, user=user)
+        yield '</ul>'
+
+
+def _render_menu(context, menu, user, viewable_nodes, current_menu_item, max_depth):
+    if renderers.use_native_renderer(menu):
+        renderer = renderers.NativeRenderer(
+            context, user, current_menu_item=current_menu_item, max_depth=max_depth)
+        return renderer.render_menu(menu, viewable_nodes)
+
+    c = {
+        'menu': menu,
+        'viewable_nodes': viewable_nodes,
+        'user': user,
+        'max_depth': max_depth,
+        'current_menu_item': current_menu_item,
+        'current_menu_lineage': get_current_lineage(
+            viewable_nodes, current_menu_item, get_children_getter(context)),
+        'menu_config': settings.NAVUTILS_MENU_CONFIG
+    }
+    return render_template(menu.template, context, menu.get_context(c))
 
 @register.simple_tag(takes_context=True)
+@instrumentation.instrument('node', lambda context, node, **kwargs: node.id)
 def render_node(context, node, **kwargs):
     # node = kwargs.get('node', context.get('node'))
     # if not node:
@@ -52,26 +272,36 @@ def render_node(context, node, **kwargs):
     if not user:
         raise ValueError('missing user parameter')
 
-    if not node.is_viewable_by(user, context):
+    get_render_state(context, create=True)
+    if not is_viewable(node, user, context):
         return ''
+    if instrumentation.enabled:
+        instrumentation.count('nodes_rendered')
 
     current = kwargs.get('current_menu_item', context.get('current_menu_item'))
     max_depth = kwargs.get('max_depth', context.get('max_depth', 999))
     start_depth = kwargs.get('start_depth', context.get('start_depth', node.depth))
     current_depth = kwargs.get('current_depth', context.get('current_depth', node.depth - start_depth))
 
+    get_children = get_children_getter(context)
     viewable_children = []
     if current_depth + 1 <= max_depth:
-        for child in node.children:
-            if child.is_viewable_by(user, context):
+        for child in get_children(node):
+            if is_viewable(child, user, context):
                 viewable_children.append(child)
 
-    t = template.loader.get_template(node.template)
+    # the lineage is computed once per menu and shared by all nodes
+    lineage = kwargs.get('current_menu_lineage')
+    if lineage is None and 'current_menu_item' not in kwargs:
+        lineage = context.get('current_menu_lineage')
+    if lineage is None:
+        lineage = get_current_lineage([node], current, get_children)
 
     c = {
         'is_current': node.is_current(current),
-        'has_current': node.has_current(current, viewable_children),
+        'has_current': node.has_current(current, viewable_children, lineage),
         'current_menu_item': current,
+        'current_menu_lineage': lineage,
         'node': node,
         'viewable_children': viewable_children,
         'user': user,
@@ -80,37 +310,49 @@ def render_node(context, node, **kwargs):
         'start_depth': start_depth,
         'menu_config': settings.NAVUTILS_MENU_CONFIG
     }
-    context.update(c)
-    final_context = node.get_context(context)
-
-    try:
-        return t.render(final_context)
-    except TypeError:
-        # Django 2.0+
-        return t.render(final_context.flatten())
+    return render_template(node.template, context, node.get_context(c))
 
 
 @register.simple_tag(takes_context=True)
 def render_crumb(context, crumb, **kwargs):
 
-    t = template.loader.get_template('navutils/crumb.html')
+    t = get_template('navutils/crumb.html')
 
-    return t.render({
+    return t.render(template.Context({
         'crumb': crumb,
         'last': kwargs.get('last', False),
-    })
+    }))
 
 @register.simple_tag(takes_context=True)
+@instrumentation.instrument('breadcrumbs', lambda context, crumbs, **kwargs: 'breadcrumbs')
 def render_breadcrumbs(context, crumbs, **kwargs):
 
-    t = template.loader.get_template('navutils/breadcrumbs.html')
+    t = get_template('navutils/breadcrumbs.html')
 
-    return t.render({
+    return t.render(template.Context({
         'crumbs': crumbs,
-    })
+    }))
+
+def get_nested_template(template_text):
+    engine = template.Engine.get_default()
+    key = (engine, template_text)
+    tpl = nested_templates.get(key)
+    if tpl is None:
+        start = time.perf_counter()
+        tpl = template.Template(template_text, engine=engine)
+        if instrumentation.enabled:
+            instrumentation.count('nested_compilations')
+            instrumentation.event(
+                'nested_compilation', source=template_text, duration=time.perf_counter() - start)
+        nested_templates.set(key, tpl)
+    return tpl
+
 
 @register.simple_tag(takes_context=True)
 def render_nested(context, template_text):
-    # create template from text
-    tpl = template.Template(template_text)
-    return tpl.render(context)
+    template_text = str(template_text)
+    if not any(marker in template_text for marker in TEMPLATE_MARKERS):
+        # plain text, no need to involve the template engine
+        return mark_safe(template_text)
+
+    return get_nested_template(template_text).render(context)
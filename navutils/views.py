@@ -1,12 +1,72 @@
+from django.http import Http404, JsonResponse
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers, quote_etag
+from django.views.generic import View
 
 
 class MenuMixin(object):
     current_menu_item = None
+    # when current_menu_item is not set, look for the node matching the
+    # request URL in the menus of the registry
+    resolve_current_menu_item = False
 
     def get_current_menu_item(self):
+        if self.current_menu_item is None and self.resolve_current_menu_item:
+            from navutils.menu import registry
+
+            return registry.match_request(self.request)
         return self.current_menu_item
 
     def get_context_data(self, **kwargs):
         context = super(MenuMixin, self).get_context_data(**kwargs)
         context['current_menu_item'] = self.get_current_menu_item()
         return context
+
+
+class MenuJSONView(View):
+    """
+    Return the nodes of a menu the requesting user can see, as JSON (see
+    :py:class:`navutils.serializers.MenuSerializer`).
+
+    The response ETag is computed from the menu structure and the visible
+    nodes, before serializing anything: clients sending it back in
+    ``If-None-Match`` get an empty ``304 Not Modified`` response as long as
+    the menu and their permissions did not change.
+
+    The menu is the ``menu_id`` URL kwarg, or the ``menu`` attribute (a menu
+    id or instance).
+    """
+    menu = None
+    max_depth = 999
+    # responses depend on the user, and should be checked again on each use
+    cache_control = {'private': True, 'no_cache': True}
+
+    def get_menu(self):
+        from navutils.menu import registry
+
+        menu = self.kwargs.get('menu_id', self.menu)
+        if not isinstance(menu, str):
+            return menu
+        try:
+            return registry[menu]
+        except KeyError:
+            raise Http404('No menu with id {0}'.format(menu))
+
+    def get_serializer(self):
+        from navutils.serializers import MenuSerializer
+
+        context = {'request': self.request, 'user': self.request.user}
+        return MenuSerializer(context, self.request.user, max_depth=self.max_depth)
+
+    def get(self, request, *args, **kwargs):
+        menu = self.get_menu()
+        serializer = self.get_serializer()
+        tree = serializer.get_tree(menu)
+        etag = quote_etag(serializer.get_etag(menu, tree))
+
+        response = get_conditional_response(request, etag=etag)
+        if response is None:
+            response = JsonResponse(serializer.serialize(menu, tree), json_dumps_params={'separators': (',', ':')})
+        response['ETag'] = etag
+        patch_cache_control(response, **self.cache_control)
+        patch_vary_headers(response, ('Cookie',))
+        return response
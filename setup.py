@@ -42,6 +42,9 @@ setup(
     },
     include_package_data=True,
     install_requires=['persisting_theory'],
+    extras_require={
+        'debug_toolbar': ['django-debug-toolbar'],
+    },
     classifiers=[
         'Development Status :: 4 - Beta',
         'Environment :: Web Environment',
@@ -0,0 +1,5 @@
+from navutils import menu
+
+lazy_menu = menu.Menu('lazy')
+lazy_menu.register(menu.Node('lazy', 'Lazy', url='/lazy'))
+menu.register(lazy_menu)
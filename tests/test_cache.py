@@ -0,0 +1,49 @@
+from unittest import mock
+
+from django.test import TestCase, override_settings
+from django.urls import reverse
+
+from navutils import Breadcrumb, cache, menu
+
+
+class ReverseCacheTest(TestCase):
+
+    def setUp(self):
+        cache.clear_reverse_cache()
+
+    def test_node_url_is_reversed_once(self):
+        node = menu.Node('test', 'Test', pattern_name='index')
+
+        with mock.patch('navutils.cache.reverse', wraps=reverse) as patched:
+            self.assertEqual(node.get_url(), '/')
+            self.assertEqual(node.get_url(), '/')
+            self.assertEqual(Breadcrumb('Test', pattern_name='index').get_url(), '/')
+
+        self.assertEqual(patched.call_count, 1)
+
+    def test_cache_is_keyed_on_reverse_kwargs(self):
+        node = menu.Node('test', 'Test', pattern_name='category', reverse_kwargs=['slug'])
+
+        self.assertEqual(node.get_url(slug='first'), '/blog/category/first')
+        self.assertEqual(node.get_url(slug='second'), '/blog/category/second')
+
+    def test_cache_is_cleared_when_urlconf_changes(self):
+        cache.cached_reverse('index')
+        self.assertEqual(len(cache.get_reverse_cache()), 1)
+
+        with override_settings(ROOT_URLCONF='tests.test_app.urls'):
+            self.assertEqual(len(cache.get_reverse_cache()), 0)
+
+    def test_menu_can_preload_urls(self):
+        main_menu = menu.Menu('main')
+        main_menu.register(menu.Node('test', 'Test', pattern_name='index', children=[
+            menu.Node('blog', 'Blog', pattern_name='blog'),
+            menu.Node('category', 'Category', pattern_name='category', reverse_kwargs=['slug']),
+        ]))
+        main_menu.preload_urls()
+
+        with mock.patch('navutils.cache.reverse') as patched:
+            self.assertEqual(main_menu['test'].get_url(), '/')
+            self.assertEqual(main_menu['test'].children[0].get_url(), '/blog')
+
+        self.assertEqual(patched.call_count, 0)
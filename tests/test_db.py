@@ -0,0 +1,147 @@
+from unittest import mock
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import AnonymousUser, Permission
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.db import IntegrityError, transaction
+from django.test import TestCase
+
+from navutils import menu
+from navutils.db import loader, models
+from navutils.templatetags import navutils_tags
+
+User = get_user_model()
+
+
+class DatabaseMenuTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        loader.clear()
+        self.user = User.objects.create(username='user')
+        self.sidebar = models.Menu.objects.create(slug='sidebar', css_class='nav')
+        self.blog = models.MenuNode.objects.create(
+            menu=self.sidebar, slug='blog', label='Blog', pattern_name='blog', weight=1)
+        models.MenuNode.objects.create(
+            menu=self.sidebar, parent=self.blog, slug='last', label='Last', url='/blog/last')
+        models.MenuNode.objects.create(
+            menu=self.sidebar, parent=self.blog, slug='admin', label='Admin', url='/blog/admin',
+            permissions='test_app.foo\ntest_app.bar', require_all_permissions=False)
+        models.MenuNode.objects.create(
+            menu=self.sidebar, slug='login', label='Login', url='/login', visibility='anonymous', weight=2)
+        models.MenuNode.objects.create(menu=self.sidebar, slug='header', label='Other', divider=True)
+
+    def tearDown(self):
+        loader.clear()
+
+    def test_menu_is_built_from_a_single_query(self):
+        # the menu pk is looked up first, to read its generation token
+        with self.assertNumQueries(2):
+            sidebar = loader.get_menu('sidebar')
+
+        self.assertIsInstance(sidebar, menu.Menu)
+        self.assertEqual(sidebar.id, 'sidebar')
+        self.assertEqual(sidebar.css_class, 'nav')
+        self.assertEqual([node.id for node in sidebar.compile().nodes], [
+            'login', 'blog', 'blog:last', 'blog:admin', 'header'])
+        self.assertIsInstance(sidebar['login'], menu.AnonymousNode)
+        self.assertEqual(sidebar['blog'].get_url(), '/blog')
+        self.assertTrue(sidebar['header'].is_divider)
+
+        admin_node = sidebar['blog'].children[1]
+        self.assertIsInstance(admin_node, menu.AnyPermissionsNode)
+        self.assertEqual(admin_node.permissions, ['test_app.foo', 'test_app.bar'])
+
+    def test_menu_is_kept_until_edited(self):
+        sidebar = loader.get_menu('sidebar')
+        with self.assertNumQueries(0):
+            self.assertIs(loader.get_menu('sidebar'), sidebar)
+
+        self.blog.label = 'News'
+        self.blog.save()
+        self.assertEqual(loader.get_menu('sidebar')['blog'].label, 'News')
+
+        models.MenuNode.objects.filter(slug='login').delete()
+        self.assertNotIn('login', loader.get_menu('sidebar'))
+
+    def test_menu_is_rebuilt_from_a_single_query(self):
+        loader.get_menu('sidebar')
+        self.blog.save()
+
+        with self.assertNumQueries(1):
+            loader.get_menu('sidebar')
+
+    def test_edits_made_while_loading_are_seen(self):
+        load_menu = loader.load_menu
+
+        def load_and_edit(slug):
+            result = load_menu(slug)
+            # saved by another request, after the nodes were queried
+            models.MenuNode.objects.filter(pk=self.blog.pk).update(label='News')
+            self.blog.save(update_fields=['weight'])
+            return result
+
+        with mock.patch.object(loader, 'load_menu', load_and_edit):
+            self.assertEqual(loader.get_menu('sidebar')['blog'].label, 'Blog')
+
+        self.assertEqual(loader.get_menu('sidebar')['blog'].label, 'News')
+
+    def test_other_processes_see_edits(self):
+        sidebar = loader.get_menu('sidebar')
+        # another process, with its own signal receivers, edits the menu
+        loader.get_generation_cache().invalidate(loader.get_generation_key(self.sidebar.pk))
+
+        self.assertIsNot(loader.get_menu('sidebar'), sidebar)
+
+    def test_missing_and_empty_menus(self):
+        with self.assertRaises(KeyError):
+            loader.get_menu('missing')
+        self.assertIsNone(loader.DatabaseMenus().get('missing'))
+
+        models.Menu.objects.create(slug='empty')
+        self.assertEqual(len(loader.get_menu('empty')), 0)
+
+    def test_rendering(self):
+        user = User.objects.get(pk=self.user.pk)
+        user.user_permissions.add(Permission.objects.get(codename='bar'))
+        context = {'db_menus': loader.DatabaseMenus()}
+
+        output = navutils_tags.render_menu(context, menu=context['db_menus']['sidebar'], user=user)
+        self.assertIn('href="/blog/admin"', output)
+        self.assertNotIn('href="/login"', output)
+
+        output = navutils_tags.render_menu(
+            context, menu=context['db_menus']['sidebar'], user=AnonymousUser())
+        self.assertNotIn('href="/blog/admin"', output)
+        self.assertIn('href="/login"', output)
+
+    def test_node_validation(self):
+        node = models.MenuNode(menu=self.sidebar, slug='node', url='/', pattern_name='index')
+        with self.assertRaises(ValidationError):
+            node.clean()
+
+        node = models.MenuNode(menu=self.sidebar, slug='node')
+        with self.assertRaises(ValidationError):
+            node.clean()
+
+        node = models.MenuNode(
+            menu=self.sidebar, slug='node', url='/', visibility='staff', permissions='test_app.foo')
+        with self.assertRaises(ValidationError):
+            node.clean()
+
+        other = models.Menu.objects.create(slug='other')
+        node = models.MenuNode(menu=other, parent=self.blog, slug='node', url='/')
+        with self.assertRaises(ValidationError):
+            node.clean()
+
+    def test_slugs_are_unique_among_siblings(self):
+        # top-level nodes have no parent, which unique_together does not cover
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            models.MenuNode.objects.create(menu=self.sidebar, slug='blog', url='/')
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            models.MenuNode.objects.create(menu=self.sidebar, parent=self.blog, slug='last', url='/')
+
+        models.MenuNode.objects.create(menu=self.sidebar, parent=self.blog, slug='blog', url='/')
+        other = models.Menu.objects.create(slug='other')
+        models.MenuNode.objects.create(menu=other, slug='blog', url='/')
@@ -0,0 +1,181 @@
+from unittest import skipUnless
+
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.test import RequestFactory, TestCase
+
+from navutils import Breadcrumb, instrumentation, menu
+from navutils.templatetags import navutils_tags
+
+try:
+    import debug_toolbar
+except ImportError:
+    debug_toolbar = None
+
+User = get_user_model()
+
+
+class InstrumentationTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='user')
+        instrumentation.enable()
+        instrumentation.aggregator.reset()
+
+    def tearDown(self):
+        instrumentation.disable()
+        instrumentation.aggregator.reset()
+
+    def build_menu(self, **kwargs):
+        main_menu = menu.Menu('main', **kwargs)
+        main_menu.register(menu.Node('first', 'First', url='/first', children=[
+            menu.Node('child', 'Child', url='/child'),
+            menu.StaffNode('staff', 'Staff', url='/staff'),
+        ]))
+        main_menu.register(menu.Node('dynamic', 'Dynamic', pattern_name='index', children=lambda: [
+            menu.Node('generated', 'Generated', url='/generated'),
+        ]))
+        main_menu.register(menu.AnonymousNode('login', 'Login', url='/login'))
+        return main_menu
+
+    def test_nothing_is_recorded_when_disabled(self):
+        instrumentation.disable()
+        with instrumentation.collect() as records:
+            navutils_tags.render_menu({}, menu=self.build_menu(), user=self.user)
+
+        self.assertEqual(records, [])
+        self.assertEqual(instrumentation.aggregator.dump()['counters'], {})
+
+    def test_render_menu_is_recorded(self):
+        with instrumentation.collect() as records:
+            navutils_tags.render_menu({}, menu=self.build_menu(), user=self.user)
+
+        self.assertEqual(len(records), 1)
+        stats = records[0]
+        self.assertEqual(stats.key, 'menu:main')
+        self.assertGreater(stats.duration, 0)
+        self.assertEqual(stats.counters['nodes_rendered'], 4)
+        self.assertEqual(stats.counters['node_calls'], 4)
+        self.assertEqual(stats.counters['nodes_filtered'], 2)
+        self.assertEqual(stats.counters['children_calls'], 1)
+        self.assertEqual(stats.counters['url_calls'], 4)
+
+    def test_native_renderer_is_recorded(self):
+        with instrumentation.collect() as records:
+            navutils_tags.render_menu({}, menu=self.build_menu(native=True), user=self.user)
+
+        self.assertEqual([stats.key for stats in records], ['menu:main'])
+        self.assertEqual(records[0].counters['nodes_rendered'], 4)
+        self.assertEqual(records[0].counters['nodes_filtered'], 2)
+
+    def test_templates_and_reverse_are_counted(self):
+        main_menu = self.build_menu()
+        cache.clear()
+        navutils_tags.clear_resolved_templates()
+        with instrumentation.collect() as records:
+            navutils_tags.render_menu({}, menu=main_menu, user=self.user)
+            navutils_tags.render_menu({}, menu=main_menu, user=self.user)
+
+        first, second = records
+        self.assertEqual(first.counters['template_loads'], 2)
+        self.assertNotIn('template_loads', second.counters)
+        self.assertEqual(second.counters['template_cache_hits'], 5)
+        self.assertEqual(second.counters['reverse_cache_hits'], 1)
+
+    def test_breadcrumbs_and_urls_are_recorded(self):
+        with instrumentation.collect() as records:
+            navutils_tags.render_breadcrumbs({}, [Breadcrumb('Home', url='/')])
+            menu.Node('test', 'Test', url='/test').get_url()
+
+        self.assertEqual([stats.key for stats in records], ['breadcrumbs:breadcrumbs', 'url:test'])
+
+    def test_rendered_signal(self):
+        received = []
+
+        def receiver(stats, **kwargs):
+            received.append(stats)
+        instrumentation.rendered.connect(receiver)
+        try:
+            navutils_tags.render_node({}, node=menu.Node('test', 'Test', url='/test'), user=self.user)
+        finally:
+            instrumentation.rendered.disconnect(receiver)
+
+        self.assertEqual([stats.key for stats in received], ['node:test'])
+
+    def test_aggregator(self):
+        main_menu = self.build_menu()
+        navutils_tags.render_menu({}, menu=main_menu, user=self.user)
+        navutils_tags.render_menu({}, menu=main_menu, user=self.user)
+
+        data = instrumentation.aggregator.dump(reset=True)
+        self.assertEqual(data['counters']['menu:main']['renderings'], 2)
+        self.assertEqual(data['counters']['menu:main']['nodes_rendered'], 8)
+        histogram = data['histograms']['menu:main']
+        self.assertEqual(histogram['count'], 2)
+        self.assertEqual(sum(histogram['counts']), 2)
+        self.assertEqual(len(histogram['counts']), len(histogram['buckets']) + 1)
+
+        self.assertEqual(instrumentation.aggregator.dump()['counters'], {})
+
+    def test_detailed_records(self):
+        def test(user, context):
+            return False
+
+        main_menu = self.build_menu()
+        main_menu.register(menu.PassTestNode('hidden', 'Hidden', url='/hidden', test=test))
+        navutils_tags.nested_templates.clear()
+        with instrumentation.collect(detailed=True) as records:
+            navutils_tags.render_menu({}, menu=main_menu, user=self.user)
+            navutils_tags.render_node({}, node=menu.Node('nested', '{{ 1|add:"1" }}', url='/nested'), user=self.user)
+            menu.Node('index', 'Index', pattern_name='index').get_url()
+
+        summary = instrumentation.summarize(records)
+        self.assertEqual([data['name'] for data in summary['renderings']], ['main', 'nested', 'index'])
+        checks = {check['node']: check for check in summary['visibility']}
+        self.assertIs(checks['hidden']['viewable'], False)
+        self.assertEqual(checks['hidden']['node_type'], 'PassTestNode')
+        self.assertIs(checks['first']['viewable'], True)
+        self.assertEqual([call['node'] for call in summary['children_calls']], ['dynamic'])
+        self.assertEqual([data['source'] for data in summary['nested_compilations']], ['{{ 1|add:"1" }}'])
+        self.assertEqual(summary['repeated_reverse_calls'], [{'pattern_name': 'index', 'kwargs': '{}', 'count': 2}])
+        self.assertEqual(summary['slowest_nodes'][0]['type'], 'node')
+        self.assertEqual(len(summary['slowest_nodes']), 4)
+
+    def test_records_are_not_detailed_by_default(self):
+        with instrumentation.collect() as records:
+            navutils_tags.render_menu({}, menu=self.build_menu(), user=self.user)
+
+        self.assertIsNone(records[0].events)
+        self.assertNotIn('events', records[0].as_dict())
+
+
+@skipUnless(debug_toolbar, 'django-debug-toolbar is not installed')
+class NavutilsPanelTest(TestCase):
+
+    def test_panel_records_renderings(self):
+        from debug_toolbar.toolbar import DebugToolbar
+        from navutils.panels import NavutilsPanel
+
+        user = User.objects.create(username='user')
+        main_menu = menu.Menu('main')
+        main_menu.register(menu.Node('test', 'Test', url='/test'))
+
+        def view(request):
+            return HttpResponse(navutils_tags.render_menu({}, menu=main_menu, user=user))
+
+        request = RequestFactory().get('/')
+        toolbar = DebugToolbar(request, view)
+        panel = NavutilsPanel(toolbar, view)
+        panel.enable_instrumentation()
+        try:
+            response = panel.process_request(request)
+        finally:
+            panel.disable_instrumentation()
+        panel.generate_stats(request, response)
+
+        self.assertFalse(instrumentation.enabled)
+        stats = panel.get_stats()
+        self.assertEqual([data['name'] for data in stats['renderings']], ['main'])
+        self.assertIn('1 renderings', panel.nav_subtitle)
+        self.assertIn('<td>main</td>', panel.content)
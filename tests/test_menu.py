@@ -1,14 +1,71 @@
+import asyncio
+import os
+import sys
+import tempfile
+import threading
+from unittest import mock, skipUnless
+
+from django.conf import settings
+from django.core.cache import cache
+from django.template import Context
 from django.test import TestCase
 from django.contrib.auth import get_user_model
 from django.contrib.auth.models import AnonymousUser, Permission
 from django.test.client import RequestFactory
+from django.urls import resolve
+from django.utils.translation import gettext_lazy
 
 from navutils import menu
+from navutils.middleware import CurrentMenuItemMiddleware
+from navutils.cache import invalidate_children, invalidate_children_on_save
+from navutils.state import CONTEXT_KEY
 from navutils.templatetags import navutils_tags
+from tests.test_app import models
+from tests.test_app.views import BlogMixin
+
+try:
+    # a django dependency since 3.0 only
+    from asgiref.sync import async_to_sync
+except ImportError:
+    async_to_sync = None
 
 User = get_user_model()
 
 
+def build_sample_menu(**kwargs):
+    """
+    A menu using most node features, to compare the output of the renderers
+    """
+    main_menu = menu.Menu('main', css_class='nav', **kwargs)
+    main_menu.register(menu.Node(
+        'blog', 'Blog', url='/blog', weight=1, attrs={'id': 'blog'},
+        children=[
+            menu.Node('last', 'Last entries', url='/blog/last', link_attrs={'target': '_blank'}),
+            menu.Node('archives', '{{ foo }}', url='/blog/archives', context={'foo': 'Archives'}),
+            menu.StaffNode('admin', 'Admin', url='/blog/admin'),
+        ]))
+    main_menu.register(menu.Node('header', 'Header', divider=True, css_class='header'))
+    main_menu.register(menu.Node(
+        'context', 'Context', url='http://test-context.com', template='test_app/test_node.html'))
+    main_menu.register(menu.AnonymousNode('login', 'Login', url='/login'))
+    main_menu.register(menu.Node(
+        'deep', 'Deep', pattern_name='index', weight=-1,
+        children=[
+            menu.Node('level1', '{{ node.id }}', url='/1', children=[
+                menu.Node('level2', 'Level 2', url='/2', css_class='{{ foo }}', children=[
+                    menu.Node('level3', 'Level 3', url='/3'),
+                ]),
+                menu.StaffNode('hidden', 'Hidden', url='/hidden', children=[
+                    menu.Node('under-hidden', 'Under hidden', url='/under-hidden'),
+                ]),
+            ]),
+            menu.Node('dynamic', 'Dynamic', url='/dynamic', children=lambda: [
+                menu.Node('generated', 'Generated', url='/generated'),
+            ]),
+        ]))
+    return main_menu
+
+
 class BaseTestCase(TestCase):
     def setUp(self):
         self.factory = RequestFactory()
@@ -35,6 +92,63 @@ class MenuTest(BaseTestCase):
         self.assertEqual(main_menu['test'], node)
 
 
+class AutodiscoveryTest(BaseTestCase):
+
+    def setUp(self):
+        super(AutodiscoveryTest, self).setUp()
+        sys.modules.pop('tests.lazy_app.menu', None)
+
+    def tearDown(self):
+        menu.registry.pop('lazy', None)
+
+    def test_lazy_autodiscovery(self):
+        registry = menu.Menus()
+        registry.register(menu.Menu('main'))
+        registry.autodiscover(['tests.lazy_app', 'tests.test_app'], lazy=True)
+
+        self.assertNotIn('tests.lazy_app.menu', sys.modules)
+        self.assertEqual(registry.discovery_times, {})
+
+        self.assertIn('main', registry)
+        self.assertIn('tests.lazy_app.menu', sys.modules)
+        self.assertEqual(list(registry.discovery_times), ['tests.lazy_app'])
+        self.assertIn('lazy', menu.registry)
+
+    def test_lazy_autodiscovery_is_thread_safe(self):
+        registry = menu.Menus()
+        registry.autodiscover(['tests.lazy_app'], lazy=True)
+        started, release = threading.Event(), threading.Event()
+
+        def discover_app(app, force_reload=False):
+            started.set()
+            release.wait(5)
+            registry.register(menu.Menu('slow'))
+
+        registry.discover_app = discover_app
+        importing = threading.Thread(target=registry.discover)
+        importing.start()
+        started.wait(5)
+
+        found = []
+        reading = threading.Thread(target=lambda: found.append(registry.get('slow')))
+        reading.start()
+        reading.join(0.1)
+        # the menu module is still being imported
+        self.assertTrue(reading.is_alive())
+
+        release.set()
+        importing.join(5)
+        reading.join(5)
+        self.assertEqual(found, [registry['slow']])
+
+    def test_autodiscovery_is_timed(self):
+        registry = menu.Menus()
+        registry.autodiscover(['tests.lazy_app', 'tests.test_app'])
+
+        self.assertIn('tests.lazy_app.menu', sys.modules)
+        self.assertEqual(list(registry.discovery_times), ['tests.lazy_app', 'tests.test_app'])
+
+
 class NodeTest(BaseTestCase):
 
     def test_menu_node_allows_arbitrary_url(self):
@@ -100,6 +214,34 @@ class NodeTest(BaseTestCase):
 
         self.assertEqual(parent.children, [child4, child1, child3, child2])
 
+    def test_menu_node_keeps_insertion_order_for_equal_weights(self):
+        children = [
+            menu.Node('c{0}'.format(i), 'Child', weight=i % 3, url='http://test.com')
+            for i in range(12)
+        ]
+        expected = sorted(children, key=lambda i: i.weight, reverse=True)
+
+        parent = menu.Node('test', 'Test', url='http://test.com', children=children)
+        self.assertEqual(parent.children, expected)
+
+        parent = menu.Node('test', 'Test', url='http://test.com')
+        for child in children:
+            parent.add(child)
+        self.assertEqual(parent.children, expected)
+
+    def test_menu_node_add_many(self):
+        child1 = menu.Node('c1', 'Child1', weight=3, url='http://test.com/child1')
+        child2 = menu.Node('c2', 'Child2', weight=1, url='http://test.com/child2')
+        child3 = menu.Node('c3', 'Child3', weight=2, url='http://test.com/child3')
+        child4 = menu.Node('c4', 'Child4', weight=2, url='http://test.com/child4')
+        parent = menu.Node('test', 'Test', url='http://test.com', children=[child1])
+
+        parent.add_many([child2, child3, child4])
+
+        self.assertEqual(parent.children, [child1, child3, child4, child2])
+        self.assertEqual(child4.parent, parent)
+        self.assertEqual(child4.id, 'test:c4')
+
     def test_children_accept_a_callable(self):
 
         def generate_children():
@@ -130,6 +272,95 @@ class NodeTest(BaseTestCase):
         self.assertEqual(child.id, 'test:c')
         self.assertEqual(subchild.id, 'test:c:sc')
 
+    def test_node_id_and_depth_are_updated_when_moved(self):
+        subchild = menu.Node('sc', 'SubChild', url='http://test.com/subchild')
+        child = menu.Node('c', 'Child', url='http://test.com/child', children=[subchild])
+        parent = menu.Node('test', 'Test', url='http://test.com', children=[child])
+        other = menu.Node('other', 'Other', url='http://test.com/other')
+        root = menu.Node('root', 'Root', url='http://test.com/root', children=[other])
+
+        self.assertEqual(subchild.id, 'test:c:sc')
+        self.assertEqual(subchild.depth, 2)
+
+        parent.remove(child)
+        self.assertEqual(parent.children, [])
+        self.assertEqual(child.id, 'c')
+        self.assertEqual(subchild.id, 'c:sc')
+        self.assertEqual(subchild.depth, 1)
+
+        other.add(child)
+        self.assertEqual(child.id, 'root:other:c')
+        self.assertEqual(child.depth, 2)
+        self.assertEqual(subchild.id, 'root:other:c:sc')
+        self.assertEqual(subchild.depth, 3)
+
+        # moving an ancestor also updates the whole subtree
+        root.remove(other)
+        parent.add(other)
+        self.assertEqual(subchild.id, 'test:other:c:sc')
+        self.assertEqual(subchild.depth, 3)
+
+    def test_nodes_share_empty_mappings(self):
+        node = menu.Node('test', 'Test', url='http://test.com', attrs={}, context={})
+        other = menu.PermissionNode('other', 'Other', url='http://test.com', permission='test_app.foo')
+
+        self.assertFalse(hasattr(node, '__dict__'))
+        self.assertFalse(hasattr(other, '__dict__'))
+        self.assertIs(node.attrs, other.attrs)
+        self.assertIs(node.link_attrs, menu.EMPTY_MAPPING)
+        self.assertIs(node.context, menu.EMPTY_MAPPING)
+
+    def test_node_subclasses_can_use_extra_attributes(self):
+        class IconNode(menu.Node):
+            def __init__(self, *args, **kwargs):
+                self.icon = kwargs.pop('icon')
+                super(IconNode, self).__init__(*args, **kwargs)
+
+        node = IconNode('test', 'Test', url='http://test.com', icon='home')
+
+        self.assertEqual(node.icon, 'home')
+        self.assertEqual(node.id, 'test')
+
+    def test_get_current_lineage(self):
+        subchild = menu.Node('sc', 'SubChild', url='http://test.com/subchild')
+        child = menu.Node('c', 'Child', url='http://test.com/child', children=[subchild])
+        other = menu.Node('o', 'Other', url='http://test.com/other')
+        parent = menu.Node('test', 'Test', url='http://test.com', children=[other, child])
+
+        self.assertEqual(menu.get_current_lineage([parent], 'test:c:sc'), {'test', 'test:c', 'test:c:sc'})
+        self.assertEqual(menu.get_current_lineage([parent], 'test:o'), {'test', 'test:o'})
+        self.assertEqual(menu.get_current_lineage([parent], 'test:missing'), set())
+        self.assertEqual(menu.get_current_lineage([parent], None), set())
+
+    def test_has_current_uses_lineage(self):
+        subchild = menu.Node('sc', 'SubChild', url='http://test.com/subchild')
+        child = menu.Node('c', 'Child', url='http://test.com/child', children=[subchild])
+        other = menu.Node('o', 'Other', url='http://test.com/other')
+        parent = menu.Node('test', 'Test', url='http://test.com', children=[other, child])
+        lineage = menu.get_current_lineage([parent], 'test:c:sc')
+
+        self.assertTrue(parent.has_current('test:c:sc', [other, child], lineage))
+        self.assertTrue(child.has_current('test:c:sc', [subchild], lineage))
+        self.assertFalse(parent.has_current('test:c:sc', [other], lineage))
+        self.assertTrue(parent.has_current('test:c:sc', [other, child]))
+
+    def test_has_current_only_explores_current_branch(self):
+        calls = []
+
+        def generate_children():
+            calls.append(1)
+            return [menu.Node('d', 'Dynamic', url='#')]
+
+        dynamic = menu.Node('dynamic', 'Dynamic', url='#', children=generate_children)
+        static = menu.Node('static', 'Static', url='#', children=[
+            menu.Node('c', 'Child', url='#'),
+        ])
+        parent = menu.Node('test', 'Test', url='http://test.com', children=[static, dynamic])
+
+        self.assertTrue(parent.has_current('test:static:c', [static, dynamic]))
+        self.assertEqual(calls, [])
+
+
 class AnonymousNodeTest(BaseTestCase):
 
     def test_is_viewable_by_anonymous_user(self):
@@ -240,6 +471,229 @@ class PassTestNode(BaseTestCase):
 
 
 
+class VisibilityMemoTest(BaseTestCase):
+
+    def test_visibility_is_checked_once_per_rendering(self):
+        calls = []
+        test = lambda user, context: calls.append(user) or True
+        main_menu = menu.Menu('main')
+        main_menu.register(menu.PassTestNode('test', 'Test', url='/', test=test, children=[
+            menu.PassTestNode('child', 'Child', url='/child', test=test),
+        ]))
+        main_menu.register(menu.PassTestNode('uncached', 'Uncached', url='/', test=test, cacheable=False))
+        context = {}
+        navutils_tags.render_menu(context, menu=main_menu, user=self.user)
+
+        # the uncached node is checked by render_menu and again when rendered
+        self.assertEqual(len(calls), 4)
+        state = context[CONTEXT_KEY]
+        self.assertEqual(state.evaluations, 4)
+        # nodes are checked before being rendered, and when rendered
+        self.assertEqual(state.saved_evaluations, 2)
+
+        calls[:] = []
+        context = {}
+        main_menu.native = True
+        navutils_tags.render_menu(context, menu=main_menu, user=self.user)
+
+        # the native renderer does not check the uncached node again
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(context[CONTEXT_KEY].evaluations, 3)
+
+    def test_visibility_is_not_shared_between_users(self):
+        calls = []
+        main_menu = menu.Menu('main')
+        main_menu.register(menu.PassTestNode(
+            'test', 'Test', url='/', test=lambda user, context: calls.append(user) or True))
+        context = {}
+        navutils_tags.render_menu(context, menu=main_menu, user=self.user)
+        navutils_tags.render_menu(context, menu=main_menu, user=self.staff_member)
+
+        self.assertEqual(calls, [self.user, self.staff_member])
+
+
+class DynamicChildrenTest(BaseTestCase):
+
+    def test_children_are_generated_once_per_rendering(self):
+        calls = []
+
+        def children():
+            calls.append(1)
+            return [menu.Node('a', 'A', url='/a'), menu.Node('b', 'B', url='/b')]
+
+        for native in [False, True]:
+            main_menu = menu.Menu('main', native=native)
+            main_menu.register(menu.Node('dynamic', 'Dynamic', url='/', children=children))
+            output = navutils_tags.render_menu({}, menu=main_menu, user=self.user, current_menu_item='b')
+
+            self.assertIn('class="menu-item has-current', output)
+        self.assertEqual(len(calls), 2)
+
+    def test_children_are_generated_on_each_rendering_by_default(self):
+        calls = []
+        main_menu = menu.Menu('main')
+        main_menu.register(menu.Node('dynamic', 'Dynamic', url='/', children=lambda: calls.append(1) or []))
+        navutils_tags.render_menu({}, menu=main_menu, user=self.user)
+        navutils_tags.render_menu({}, menu=main_menu, user=self.user)
+
+        self.assertEqual(len(calls), 2)
+
+    def test_children_timeout(self):
+        calls = []
+        main_menu = menu.Menu('main')
+        main_menu.register(menu.Node(
+            'dynamic', 'Dynamic', url='/', children=lambda: calls.append(1) or [], children_timeout=60))
+        with mock.patch('navutils.menu.time.monotonic', return_value=1000):
+            navutils_tags.render_menu({}, menu=main_menu, user=self.user)
+            navutils_tags.render_menu({}, menu=main_menu, user=self.user)
+        self.assertEqual(len(calls), 1)
+
+        with mock.patch('navutils.menu.time.monotonic', return_value=1061):
+            navutils_tags.render_menu({}, menu=main_menu, user=self.user)
+        self.assertEqual(len(calls), 2)
+
+    def test_children_cache_keys(self):
+        calls = []
+        main_menu = menu.Menu('main')
+        main_menu.register(menu.Node(
+            'dynamic', 'Dynamic', url='/', children=lambda: calls.append(1) or [],
+            children_cache_keys=['articles']))
+        navutils_tags.render_menu({}, menu=main_menu, user=self.user)
+        navutils_tags.render_menu({}, menu=main_menu, user=self.user)
+        self.assertEqual(len(calls), 1)
+
+        invalidate_children('other')
+        navutils_tags.render_menu({}, menu=main_menu, user=self.user)
+        self.assertEqual(len(calls), 1)
+
+        invalidate_children('articles')
+        navutils_tags.render_menu({}, menu=main_menu, user=self.user)
+        self.assertEqual(len(calls), 2)
+
+    def test_children_are_invalidated_on_save(self):
+        calls = []
+        invalidate_children_on_save(models.TestModel)
+        main_menu = menu.Menu('main')
+        main_menu.register(menu.Node(
+            'dynamic', 'Dynamic', url='/', children=lambda: calls.append(1) or [],
+            children_cache_keys=['test_app.TestModel']))
+        navutils_tags.render_menu({}, menu=main_menu, user=self.user)
+
+        instance = models.TestModel.objects.create()
+        navutils_tags.render_menu({}, menu=main_menu, user=self.user)
+        self.assertEqual(len(calls), 2)
+
+        instance.delete()
+        navutils_tags.render_menu({}, menu=main_menu, user=self.user)
+        self.assertEqual(len(calls), 3)
+
+
+@skipUnless(async_to_sync, 'asgiref is not installed')
+class AsyncRenderingTest(BaseTestCase):
+
+    def arender_menu(self, context, **kwargs):
+        return async_to_sync(navutils_tags.arender_menu)(context, **kwargs)
+
+    def test_async_rendering_matches_sync_rendering(self):
+        async def test(user, context):
+            return user.is_authenticated
+
+        async def children():
+            return [menu.Node('async-child', 'Async child', url='/async/child')]
+
+        for native in [False, True]:
+            main_menu = build_sample_menu(native=native)
+            main_menu.register(menu.PassTestNode('async', 'Async', url='/async', test=test, children=[
+                menu.Node('async-dynamic', 'Async dynamic', url='/async/dynamic', children=children),
+            ]))
+            for kwargs in [{}, {'current_menu_item': 'async-child'}, {'current_menu_item': 'generated'},
+                           {'max_depth': 0}]:
+                for user in [self.user, self.anonymous_user]:
+                    self.assertHTMLEqual(
+                        self.arender_menu({'foo': 'bar'}, menu=main_menu, user=user, **kwargs),
+                        navutils_tags.render_menu({'foo': 'bar'}, menu=main_menu, user=user, **kwargs),
+                    )
+
+    def test_async_predicates(self):
+        async def test(user, context):
+            return user.is_authenticated
+
+        main_menu = menu.Menu('main')
+        main_menu.register(menu.PassTestNode('private', 'Private', url='/private', test=test, children=[
+            menu.Node('sync', 'Sync', url='/sync', children=lambda: [
+                menu.Node('sync-child', 'Sync child', url='/sync/child'),
+            ]),
+        ]))
+
+        self.assertIn('/sync/child', self.arender_menu({}, menu=main_menu, user=self.user))
+        self.assertNotIn('/private', self.arender_menu({}, menu=main_menu, user=self.anonymous_user))
+
+    def test_sibling_children_are_resolved_concurrently(self):
+        events = []
+
+        def children(name):
+            async def generate_children():
+                events.append(('start', name))
+                await asyncio.sleep(0)
+                events.append(('end', name))
+                return [menu.Node(name + '-child', 'Child', url='/' + name + '/child')]
+            return generate_children
+
+        main_menu = menu.Menu('main')
+        main_menu.register(menu.Node('first', 'First', url='/first', children=children('first')))
+        main_menu.register(menu.Node('second', 'Second', url='/second', children=children('second')))
+        context = {}
+        self.arender_menu(context, menu=main_menu, user=self.user, current_menu_item='second-child')
+
+        # each callable is only called once, even to find the current node
+        self.assertEqual([event for event, name in events], ['start', 'start', 'end', 'end'])
+        self.assertTrue(context[CONTEXT_KEY].resolved)
+
+    def test_children_of_hidden_nodes_are_not_generated(self):
+        calls = []
+
+        def children():
+            calls.append(True)
+            return [menu.Node('child', 'Child', url='/admin/child')]
+
+        for native in [False, True]:
+            main_menu = menu.Menu('main', native=native)
+            main_menu.register(menu.StaffNode('admin', 'Admin', url='/admin', children=children))
+            main_menu.register(menu.Node('blog', 'Blog', url='/blog'))
+
+            # the current node is in another menu, so it is looked for in dynamic children
+            for kwargs in [{}, {'current_menu_item': 'elsewhere'}]:
+                navutils_tags.render_menu({}, menu=main_menu, user=self.anonymous_user, **kwargs)
+                self.assertNotIn(
+                    '/admin', self.arender_menu({}, menu=main_menu, user=self.anonymous_user, **kwargs))
+        self.assertEqual(calls, [])
+
+    def test_async_children_of_hidden_nodes_with_native_rendering(self):
+        async def children():
+            return [menu.Node('child', 'Child', url='/admin/child')]
+
+        main_menu = menu.Menu('main', native=True)
+        main_menu.register(menu.StaffNode('admin', 'Admin', url='/admin', children=children))
+        main_menu.register(menu.Node('blog', 'Blog', url='/blog'))
+
+        output = self.arender_menu({}, menu=main_menu, user=self.anonymous_user, current_menu_item='elsewhere')
+        self.assertIn('/blog', output)
+        self.assertNotIn('/admin', output)
+
+    def test_sync_rendering_supports_async_callables(self):
+        async def test(user, context):
+            return user.is_authenticated
+
+        async def children():
+            return [menu.Node('child', 'Child', url='/private/child')]
+
+        main_menu = menu.Menu('main')
+        main_menu.register(menu.PassTestNode('private', 'Private', url='/private', test=test, children=children))
+
+        self.assertIn('/private/child', navutils_tags.render_menu({}, menu=main_menu, user=self.user))
+        self.assertNotIn('/private', navutils_tags.render_menu({}, menu=main_menu, user=self.anonymous_user))
+
+
 class RenderNodeTest(BaseTestCase):
 
     def test_render_node_template_tag(self):
@@ -435,6 +889,53 @@ class MenuMixinTest(BaseTestCase):
         response = self.client.get('/')
         self.assertEqual(response.context['current_menu_item'], 'test:index')
 
+    def test_resolve_current_menu_item(self):
+        main_menu = menu.Menu('main')
+        main_menu.register(menu.Node('blog', 'Blog', pattern_name='blog'))
+        registry = menu.Menus()
+        registry.register(main_menu)
+
+        class View(BlogMixin):
+            resolve_current_menu_item = True
+
+        request = self.factory.get('/blog')
+        with mock.patch.object(menu, 'registry', registry):
+            response = View.as_view(template_name='test_app/base.html')(request)
+        self.assertEqual(response.context_data['current_menu_item'], 'blog')
+
+    def test_current_menu_item_middleware(self):
+        main_menu = menu.Menu('main')
+        main_menu.register(menu.Node('blog', 'Blog', url='/blog', children=[
+            menu.Node('category', 'Category', url='/blog/category'),
+        ]))
+        registry = menu.Menus()
+        registry.register(main_menu)
+
+        request = self.factory.get('/blog/category/test')
+        request.resolver_match = resolve('/blog/category/test')
+        request.user = self.user
+        middleware = CurrentMenuItemMiddleware(lambda request: None)
+        with mock.patch.object(menu, 'registry', registry):
+            middleware.process_view(request, None, (), {})
+        self.assertEqual(request.current_menu_item, 'blog:category')
+
+        output = navutils_tags.render_menu({'request': request}, menu=main_menu)
+        self.assertIn('menu-item current', output)
+
+    def test_current_menu_item_middleware_ignores_urls_that_cannot_be_reversed(self):
+        main_menu = menu.Menu('main')
+        main_menu.register(menu.Node('blog', 'Blog', url='/blog'))
+        main_menu.register(menu.StaffNode('admin', 'Admin', pattern_name='not-in-this-urlconf'))
+        registry = menu.Menus()
+        registry.register(main_menu)
+
+        request = self.factory.get('/blog/category/test')
+        request.resolver_match = resolve('/blog/category/test')
+        middleware = CurrentMenuItemMiddleware(lambda request: None)
+        with mock.patch.object(menu, 'registry', registry):
+            middleware.process_view(request, None, (), {})
+        self.assertEqual(request.current_menu_item, 'blog')
+
 
 class RenderMenuTest(BaseTestCase):
 
@@ -470,3 +971,510 @@ class RenderMenuTest(BaseTestCase):
             </ul>
             """
         )
+
+    def test_page_context_is_left_untouched(self):
+        main_menu = menu.Menu('main')
+        main_menu.register(menu.Node('first', 'First', url='/first', children=[
+            menu.Node('child', 'Child', url='/child'),
+        ]))
+        main_menu.register(menu.Node('second', 'Second', url='/second'))
+        for native in [False, True]:
+            main_menu.native = native
+            context = Context({'foo': 'bar'})
+            size = len(context.dicts)
+            navutils_tags.render_menu(context, menu=main_menu, user=self.user)
+
+            self.assertEqual(len(context.dicts), size)
+            self.assertNotIn('node', context)
+            self.assertNotIn('current_depth', context)
+
+    def test_sibling_depth_does_not_leak(self):
+        main_menu = menu.Menu('main')
+        main_menu.register(menu.Node('first', 'First', url='/first', weight=1, children=[
+            menu.Node('child', 'Child', url='/child', children=[
+                menu.Node('subchild', 'Subchild', url='/subchild'),
+            ]),
+        ]))
+        main_menu.register(menu.Node('second', 'Second', url='/second', children=[
+            menu.Node('other', 'Other', url='/other'),
+        ]))
+        output = navutils_tags.render_menu({}, menu=main_menu, user=self.user, max_depth=1)
+
+        self.assertNotIn('/subchild', output)
+        self.assertIn('/other', output)
+
+
+class NativeRendererTest(BaseTestCase):
+
+    def test_native_renderer_matches_templates(self):
+        for kwargs in [
+                {},
+                {'current_menu_item': 'blog:last'},
+                {'current_menu_item': 'deep:level1:level2:level3'},
+                {'current_menu_item': 'deep:level1'},
+                {'current_menu_item': 'generated'},
+                {'max_depth': 0},
+                {'max_depth': 1},
+                {'max_depth': 2}]:
+            expected = navutils_tags.render_menu(
+                {'foo': 'bar'}, menu=build_sample_menu(native=False), user=self.user, **kwargs)
+            output = navutils_tags.render_menu(
+                {'foo': 'bar'}, menu=build_sample_menu(native=True), user=self.user, **kwargs)
+
+            self.assertHTMLEqual(output, expected)
+
+    def test_native_renderer_output(self):
+        output = navutils_tags.render_menu(
+            {'foo': 'bar'}, menu=build_sample_menu(native=True), user=self.user,
+            current_menu_item='blog:archives')
+
+        self.assertHTMLEqual(
+            output,
+            """
+            <ul class="main-menu nav">
+                <li class="menu-item has-current has-children has-dropdown" id="blog">
+                    <a href="/blog">Blog</a>
+                    <ul class="sub-menu dropdown">
+                        <li class="menu-item"><a href="/blog/last" target="_blank">Last entries</a></li>
+                        <li class="menu-item current"><a href="/blog/archives">Archives</a></li>
+                    </ul>
+                </li>
+                <li class="menu-item header">Header</li>
+                <li class="menu-item"><a href="http://test-context.com">Context bar</a></li>
+                <li class="menu-item has-children has-dropdown">
+                    <a href="/">Deep</a>
+                    <ul class="sub-menu dropdown">
+                        <li class="menu-item has-children has-dropdown">
+                            <a href="/1">deep:level1</a>
+                            <ul class="sub-menu dropdown">
+                                <li class="menu-item bar has-children has-dropdown">
+                                    <a href="/2">Level 2</a>
+                                    <ul class="sub-menu dropdown">
+                                        <li class="menu-item"><a href="/3">Level 3</a></li>
+                                    </ul>
+                                </li>
+                            </ul>
+                        </li>
+                        <li class="menu-item has-children has-dropdown">
+                            <a href="/dynamic">Dynamic</a>
+                            <ul class="sub-menu dropdown">
+                                <li class="menu-item"><a href="/generated">Generated</a></li>
+                            </ul>
+                        </li>
+                    </ul>
+                </li>
+            </ul>
+            """)
+
+    def test_stream_menu_matches_render_menu(self):
+        for kwargs in [
+                {},
+                {'current_menu_item': 'deep:level1:level2:level3'},
+                {'current_menu_item': 'generated'},
+                {'max_depth': 1}]:
+            expected = navutils_tags.render_menu(
+                {'foo': 'bar'}, menu=build_sample_menu(), user=self.user, **kwargs)
+            for native in [False, True]:
+                chunks = list(navutils_tags.stream_menu(
+                    {'foo': 'bar'}, menu=build_sample_menu(native=native), user=self.user, chunk_size=1,
+                    **kwargs))
+
+                self.assertGreater(len(chunks), 1)
+                self.assertHTMLEqual(''.join(chunks), expected)
+
+    def test_stream_menu_uses_overridden_templates(self):
+        main_menu = menu.Menu('main')
+        main_menu.register(menu.Node('blog', 'Blog', url='/blog'))
+        main_menu.register(menu.Node('login', 'Login', url='/login'))
+
+        with tempfile.TemporaryDirectory() as directory:
+            os.makedirs(os.path.join(directory, 'navutils'))
+            for name, source in [
+                    ('node.html', '<li class="custom-node">{{ node.label }}</li>'),
+                    ('menu.html', '<ol>{% load navutils_tags %}{% for node in viewable_nodes %}'
+                                  '{% render_node node=node user=user %}{% endfor %}</ol>')]:
+                with open(os.path.join(directory, 'navutils', name), 'w') as f:
+                    f.write(source)
+                templates = [dict(settings.TEMPLATES[0], DIRS=[directory])]
+                with self.settings(TEMPLATES=templates):
+                    expected = navutils_tags.render_menu({}, menu=main_menu, user=self.user)
+                    chunks = list(navutils_tags.stream_menu({}, menu=main_menu, user=self.user, chunk_size=1))
+
+                self.assertIn('custom-node', expected)
+                self.assertHTMLEqual(''.join(chunks), expected)
+        self.assertEqual(len(chunks), 1)
+
+    def test_stream_menu_chunk_size(self):
+        main_menu = menu.Menu('main')
+        for i in range(100):
+            main_menu.register(menu.Node('n{0}'.format(i), 'Node {0}'.format(i), url='/{0}'.format(i)))
+
+        chunks = list(navutils_tags.stream_menu({}, menu=main_menu, user=self.user, chunk_size=500))
+
+        self.assertGreater(len(chunks), 1)
+        self.assertTrue(all(len(chunk) >= 500 for chunk in chunks[:-1]))
+        self.assertHTMLEqual(''.join(chunks), navutils_tags.render_menu({}, menu=main_menu, user=self.user))
+
+    def test_stream_menu_with_custom_template(self):
+        main_menu = menu.Menu('main', template='test_app/test_menu.html')
+        main_menu.register(menu.Node('blog', 'Blog', url='/blog'))
+
+        chunks = list(navutils_tags.stream_menu({}, menu=main_menu, user=self.user))
+
+        self.assertEqual(len(chunks), 1)
+        self.assertIn('custom-menu', chunks[0])
+        self.assertEqual(chunks[0], navutils_tags.render_menu({}, menu=main_menu, user=self.user))
+
+    def test_stream_menu_keeps_the_caller_context(self):
+        main_menu = menu.Menu('main')
+        main_menu.register(menu.Node('blog', 'Blog', url='/blog'))
+        main_menu.register(menu.Node('login', 'Login', url='/login'))
+        context = Context({'foo': 'bar'})
+        chunks = navutils_tags.stream_menu(context, menu=main_menu, user=self.user, chunk_size=1)
+
+        next(chunks)
+        self.assertNotIn('menu', context)
+        context.push(x=1)
+        list(chunks)
+        self.assertIn('x', context)
+        self.assertNotIn('menu', context)
+        context.pop()
+        self.assertEqual(context['foo'], 'bar')
+
+    def test_stream_menu_checks_arguments_at_once(self):
+        main_menu = menu.Menu('main')
+        main_menu.register(menu.Node('blog', 'Blog', url='/blog'))
+
+        with self.assertRaises(ValueError):
+            navutils_tags.stream_menu({}, menu=main_menu)
+        self.assertEqual(
+            list(navutils_tags.stream_menu({}, menu=menu.Menu('empty'), user=self.user)), [])
+
+
+class CompiledMenuTest(BaseTestCase):
+
+    def test_compiled_menu_is_flattened_in_pre_order(self):
+        main_menu = menu.Menu('main')
+        main_menu.register(menu.Node('first', 'First', url='/first', weight=1, children=[
+            menu.Node('c', 'Child', url='/c', children=[
+                menu.Node('sc', 'SubChild', pattern_name='index'),
+            ]),
+            menu.Node('d', 'Dynamic', url='/d', children=lambda: []),
+        ]))
+        main_menu.register(menu.Node('second', 'Second', url='/second', weight=2))
+        compiled = main_menu.compile()
+
+        self.assertEqual(compiled.ids, ('second', 'first', 'first:c', 'first:c:sc', 'first:d'))
+        self.assertEqual(compiled.depths, (0, 0, 1, 2, 1))
+        self.assertEqual(compiled.parents, (-1, -1, 1, 2, 1))
+        self.assertEqual(compiled.ends, (1, 5, 4, 4, 5))
+        self.assertEqual(compiled.urls, ('/second', '/first', '/c', '/', '/d'))
+        self.assertEqual(compiled.dynamic, (False, False, False, False, True))
+
+        self.assertEqual(compiled.get_current_lineage('first:c:sc'), {'first', 'first:c', 'first:c:sc'})
+        self.assertEqual(compiled.get_current_lineage('missing'), set())
+
+    def test_compiled_menu_lineage_with_dynamic_children(self):
+        main_menu = menu.Menu('main')
+        main_menu.register(menu.Node('first', 'First', url='/first', children=[
+            menu.Node('d', 'Dynamic', url='/d', children=lambda: [
+                menu.Node('generated', 'Generated', url='/generated'),
+            ]),
+        ]))
+
+        self.assertEqual(
+            main_menu.compile().get_current_lineage('generated'), {'first', 'first:d', 'generated'})
+        self.assertEqual(
+            menu.get_current_lineage(main_menu.values(), 'generated'), {'first', 'first:d', 'generated'})
+        # hidden top-level nodes are not searched
+        self.assertEqual(main_menu.compile().get_current_lineage('generated', viewable_roots=[]), set())
+
+    def test_compiled_menu_is_rebuilt_when_structure_changes(self):
+        child = menu.Node('c', 'Child', url='/c')
+        main_menu = menu.Menu('main')
+        main_menu.register(menu.Node('first', 'First', url='/first', children=[child]))
+        main_menu.register(menu.Node('second', 'Second', url='/second'))
+        compiled = main_menu.compile()
+        self.assertIs(main_menu.compile(), compiled)
+
+        child.add(menu.Node('new', 'New', url='/new'))
+        self.assertIn('first:c:new', main_menu.compile().ids)
+
+        main_menu.unregister('second')
+        self.assertNotIn('second', main_menu.compile().ids)
+
+        main_menu.register(menu.Node('third', 'Third', url='/third'))
+        self.assertIn('third', main_menu.compile().ids)
+
+    def test_urls_that_cannot_be_reversed_are_left_to_rendering(self):
+        main_menu = menu.Menu('main')
+        main_menu.register(menu.Node('blog', 'Blog', url='/blog'))
+        main_menu.register(menu.StaffNode('admin', 'Admin', pattern_name='not-in-this-urlconf'))
+
+        self.assertEqual(main_menu.compile().urls, ('/blog', None))
+        output = navutils_tags.render_menu({}, menu=main_menu, user=self.anonymous_user, native=True)
+        self.assertIn('href="/blog"', output)
+        self.assertNotIn('Admin', output)
+
+
+class StructureHashTest(BaseTestCase):
+
+    def test_hash_is_the_same_for_the_same_definitions(self):
+        hashes = set()
+        for attrs in [{'title': 'Child', 'data-id': 'c'}, {'data-id': 'c', 'title': 'Child'}]:
+            main_menu = menu.Menu('main')
+            main_menu.register(menu.Node('first', 'First', url='/first', children=[
+                menu.Node('c', 'Child', url='/c', attrs=attrs),
+            ]))
+            hashes.add((main_menu.get_structure_hash(), main_menu['first'].get_hash()))
+        self.assertEqual(len(hashes), 1)
+
+        main_menu['first'].children[0].label = gettext_lazy('Child')
+        self.assertEqual({(main_menu.get_structure_hash(), main_menu['first'].get_hash())}, hashes)
+
+    def test_attribute_changes(self):
+        child = menu.Node('c', 'Child', url='/c')
+        first = menu.Node('first', 'First', url='/first', children=[child])
+        second = menu.PermissionNode('second', 'Second', url='/second', permission='test_app.foo')
+        main_menu = menu.Menu('main')
+        main_menu.register(first)
+        main_menu.register(second)
+        structure_hash = main_menu.get_structure_hash()
+        first_hash = first.get_hash()
+        second_hash = second.get_hash()
+        self.assertIn('/c', main_menu.compile().urls)
+        menu_version, first_version, child_version = main_menu.version, first.version, child.version
+
+        child.url = '/other'
+
+        self.assertEqual(child.version, child_version + 1)
+        self.assertEqual(first.version, first_version + 1)
+        self.assertEqual(main_menu.version, menu_version + 1)
+        self.assertNotEqual(first.get_hash(), first_hash)
+        self.assertNotEqual(main_menu.get_structure_hash(), structure_hash)
+        self.assertIn('/other', main_menu.compile().urls)
+        # other subtrees are not computed again
+        self.assertEqual(second._hash, second_hash)
+
+        second.permission = 'test_app.bar'
+        self.assertNotEqual(second.get_hash(), second_hash)
+
+        main_menu.css_class = 'nav'
+        self.assertEqual(main_menu.version, menu_version + 3)
+
+        child.attrs = dict(child.attrs, title='Title')
+        self.assertEqual(main_menu.version, menu_version + 4)
+
+    def test_construction_is_not_a_change(self):
+        self.assertEqual(menu.Node('leaf', 'Leaf', url='/leaf').version, 0)
+        self.assertEqual(menu.PermissionNode('leaf', 'Leaf', url='/leaf', permission='test_app.foo').version, 0)
+
+    def test_tree_changes(self):
+        child = menu.Node('c', 'Child', url='/c')
+        main_menu = menu.Menu('main')
+        main_menu.register(menu.Node('first', 'First', url='/first', children=[child]))
+        hashes = {main_menu.get_structure_hash()}
+
+        child.add(menu.Node('new', 'New', url='/new'))
+        hashes.add(main_menu.get_structure_hash())
+        main_menu.register(menu.Node('third', 'Third', url='/third'))
+        hashes.add(main_menu.get_structure_hash())
+        main_menu.unregister('third')
+        hashes.add(main_menu.get_structure_hash())
+        main_menu['first'].remove(child)
+        hashes.add(main_menu.get_structure_hash())
+
+        self.assertEqual(len(hashes), 4)
+
+
+class MenuIndexTest(BaseTestCase):
+
+    def test_find(self):
+        child = menu.Node('c', 'Child', url='/c', children=[menu.Node('sc', 'SubChild', url='/sc')])
+        main_menu = menu.Menu('main')
+        main_menu.register(menu.Node('first', 'First', url='/first', children=[
+            child,
+            menu.Node('d', 'Dynamic', url='/d', children=lambda: [
+                menu.Node('generated', 'Generated', url='/generated'),
+            ]),
+        ]))
+
+        self.assertIs(main_menu.find('first:c'), child)
+        self.assertEqual(main_menu.find('first:c:sc').label, 'SubChild')
+        self.assertIsNone(main_menu.find('generated'))
+        self.assertEqual(main_menu.find('missing', 'default'), 'default')
+
+        registry = menu.Menus()
+        registry.register(main_menu)
+        self.assertIs(registry.find('main', 'first:c'), child)
+        self.assertIsNone(registry.find('main', 'missing'))
+        self.assertIsNone(registry.find('missing', 'first:c'))
+
+    def test_index_is_updated(self):
+        child = menu.Node('c', 'Child', url='/c')
+        main_menu = menu.Menu('main')
+        main_menu.register(menu.Node('first', 'First', url='/first', children=[child]))
+        main_menu.find('first')
+
+        new = menu.Node('new', 'New', url='/new', children=[menu.Node('leaf', 'Leaf', url='/leaf')])
+        child.add(new)
+        self.assertIs(main_menu.find('first:c:new:leaf').parent, new)
+
+        child.add_many([menu.Node('other', 'Other', url='/other')])
+        self.assertEqual(main_menu.find('first:c:other').label, 'Other')
+
+        main_menu.register(menu.Node('second', 'Second', url='/second'))
+        self.assertEqual(main_menu.find('second').label, 'Second')
+
+        main_menu['first'].remove(child)
+        self.assertIsNone(main_menu.find('first:c'))
+        self.assertIsNone(main_menu.find('first:c:new:leaf'))
+
+        main_menu.unregister('first')
+        self.assertIsNone(main_menu.find('first'))
+        self.assertEqual(main_menu.find('second').label, 'Second')
+
+        main_menu.register(menu.Node('second', 'Replaced', url='/second'))
+        self.assertEqual(main_menu.find('second').label, 'Replaced')
+
+    def test_dict_methods_update_the_index(self):
+        main_menu = menu.Menu('main')
+        for id in ['first', 'second', 'third', 'fourth']:
+            main_menu.register(menu.Node(id, id.title(), url='/' + id))
+        main_menu.find('first')
+
+        for change in [
+                lambda: main_menu.pop('first'),
+                lambda: main_menu.popitem(),
+                lambda: main_menu.setdefault('fifth', menu.Node('fifth', 'Fifth', url='/fifth'))]:
+            version = main_menu.version
+            change()
+            self.assertGreater(main_menu.version, version)
+        self.assertIsNone(main_menu.find('first'))
+        self.assertIsNone(main_menu.find('fourth'))
+        self.assertEqual(main_menu.find('fifth').label, 'Fifth')
+        self.assertIsNone(main_menu.pop('missing', None))
+
+        version = main_menu.version
+        main_menu.setdefault('fifth', menu.Node('fifth', 'Other', url='/fifth'))
+        self.assertEqual(main_menu.version, version)
+
+        second = main_menu['second']
+        main_menu.clear()
+        self.assertGreater(main_menu.version, version)
+        self.assertIsNone(main_menu.find('second'))
+        self.assertEqual(main_menu.compile().nodes, ())
+        self.assertIsNone(second.get_menu())
+
+
+class UrlIndexTest(BaseTestCase):
+
+    def test_match(self):
+        main_menu = menu.Menu('main')
+        main_menu.register(menu.Node('home', 'Home', pattern_name='index'))
+        main_menu.register(menu.Node('blog', 'Blog', pattern_name='blog', children=[
+            menu.Node('category', 'Category', pattern_name='category', reverse_kwargs=['slug']),
+            menu.Node('archives', 'Archives', url='/blog/archives/?page=1'),
+            menu.Node('external', 'External', url='http://example.com/blog/archives/2020'),
+        ]))
+        main_menu.register(menu.Node('duplicate', 'Duplicate', url='/blog/'))
+        index = main_menu.compile().get_url_index()
+
+        self.assertEqual(index.match_path('/'), ('home', 0))
+        self.assertEqual(index.match_path('/blog'), ('blog', 1))
+        self.assertEqual(index.match_path('/blog/'), ('blog', 1))
+        self.assertEqual(index.match_path('/blog/archives/2020/'), ('blog:archives', 2))
+        self.assertEqual(index.match_path('/blog/unknown'), ('blog', 1))
+        # the root URL only matches itself
+        self.assertEqual(index.match_path('/unknown'), (None, -1))
+
+        self.assertEqual(index.match_view('blog', {}), 'blog')
+        self.assertEqual(index.match_view('category', {'slug': 'test'}), 'blog:category')
+        self.assertIsNone(index.match_view('category', {}))
+        self.assertIsNone(index.match_view('missing', {}))
+
+    def test_index_is_rebuilt_when_menu_changes(self):
+        main_menu = menu.Menu('main')
+        main_menu.register(menu.Node('home', 'Home', pattern_name='index'))
+        self.assertEqual(main_menu.compile().get_url_index().match_path('/new'), (None, -1))
+
+        main_menu.register(menu.Node('new', 'New', url='/new'))
+        self.assertEqual(main_menu.compile().get_url_index().match_path('/new'), ('new', 1))
+
+        main_menu['new'].url = '/other'
+        self.assertEqual(main_menu.compile().get_url_index().match_path('/other'), ('new', 1))
+
+    def test_registry_match(self):
+        main_menu = menu.Menu('main')
+        main_menu.register(menu.Node('home', 'Home', pattern_name='index'))
+        main_menu.register(menu.Node('blog', 'Blog', pattern_name='blog', children=[
+            menu.Node('category', 'Category', pattern_name='category', reverse_kwargs=['slug']),
+            menu.Node('archives', 'Archives', url='/blog/archives'),
+        ]))
+        other_menu = menu.Menu('other')
+        other_menu.register(menu.Node('deep', 'Deep', url='/blog/archives/2020'))
+        registry = menu.Menus()
+        registry.register(main_menu)
+        registry.register(other_menu)
+
+        self.assertEqual(registry.match('/blog/archives/2020/01'), 'deep')
+        self.assertEqual(registry.match('/blog/archives'), 'blog:archives')
+        self.assertEqual(registry.match('/blog/archives', view_name='index'), 'home')
+        self.assertIsNone(registry.match('/unknown'))
+
+        request = self.factory.get('/blog/category/test')
+        request.resolver_match = resolve('/blog/category/test')
+        self.assertEqual(registry.match_request(request), 'blog:category')
+        self.assertEqual(registry.match_request(self.factory.get('/blog/other')), 'blog')
+
+
+class FragmentCacheTest(BaseTestCase):
+
+    def setUp(self):
+        super(FragmentCacheTest, self).setUp()
+        cache.clear()
+        self.cached_menu = menu.Menu('cached', cache=True)
+        self.cached_menu.register(menu.Node('test', '{{ label }}', url='http://test.com'))
+        self.cached_menu.register(menu.AuthenticatedNode('logout', 'Logout', url='/logout'))
+
+    def test_rendered_menu_is_cached_until_invalidation(self):
+        output = navutils_tags.render_menu({'label': 'Test'}, menu=self.cached_menu, user=self.user)
+
+        self.assertEqual(
+            navutils_tags.render_menu({'label': 'Updated'}, menu=self.cached_menu, user=self.user), output)
+
+        self.cached_menu.invalidate()
+        self.assertIn(
+            'Updated', navutils_tags.render_menu({'label': 'Updated'}, menu=self.cached_menu, user=self.user))
+
+    def test_cache_is_keyed_on_menu_structure(self):
+        navutils_tags.render_menu({'label': 'Test'}, menu=self.cached_menu, user=self.user)
+
+        self.cached_menu['test'].label = 'Changed'
+        self.assertIn(
+            'Changed', navutils_tags.render_menu({'label': 'Test'}, menu=self.cached_menu, user=self.user))
+
+    def test_cache_is_shared_between_users_with_same_visibility(self):
+        output = navutils_tags.render_menu({'label': 'Test'}, menu=self.cached_menu, user=self.user)
+
+        self.assertEqual(
+            navutils_tags.render_menu({'label': 'Updated'}, menu=self.cached_menu, user=self.staff_member),
+            output)
+
+        anonymous_output = navutils_tags.render_menu(
+            {'label': 'Updated'}, menu=self.cached_menu, user=self.anonymous_user)
+        self.assertNotIn('Logout', anonymous_output)
+        self.assertIn('Updated', anonymous_output)
+
+    def test_cache_is_keyed_on_dynamic_children(self):
+        labels = ['First']
+
+        def children():
+            return [menu.Node('child', labels[0], url='/child')]
+
+        cached_menu = menu.Menu('cached', cache=True)
+        cached_menu.register(menu.Node('parent', 'Parent', url='/parent', children=children))
+        self.assertIn('First', navutils_tags.render_menu({}, menu=cached_menu, user=self.user))
+
+        labels[0] = 'Second'
+        self.assertIn('Second', navutils_tags.render_menu({}, menu=cached_menu, user=self.user))
@@ -0,0 +1,96 @@
+from unittest import mock
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.backends import ModelBackend
+from django.contrib.auth.models import Permission
+from django.test import TestCase, override_settings
+
+from navutils import menu, permissions
+from navutils.templatetags import navutils_tags
+
+User = get_user_model()
+
+
+class CustomBackend(object):
+    def authenticate(self, request, **credentials):
+        return None
+
+    def has_perm(self, user, perm, obj=None):
+        return perm == 'test_app.bar'
+
+
+class OptOutBackend(ModelBackend):
+    navutils_batch_permissions = False
+
+
+class BatchPermissionsTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='user')
+        self.user.user_permissions.add(Permission.objects.get(codename='foo'))
+        self.user = User.objects.get(pk=self.user.pk)
+
+        self.menu = menu.Menu('main')
+        self.menu.register(menu.PermissionNode('foo', 'Foo', url='/foo', permission='test_app.foo', children=[
+            menu.AllPermissionsNode('all', 'All', url='/all', permissions=['test_app.foo', 'test_app.bar']),
+            menu.AnyPermissionsNode('any', 'Any', url='/any', permissions=['test_app.foo', 'test_app.bar']),
+        ]))
+        self.menu.register(menu.PermissionNode('bar', 'Bar', url='/bar', permission='test_app.bar'))
+
+    def render(self):
+        return navutils_tags.render_menu({}, menu=self.menu, user=self.user)
+
+    def test_permissions_are_fetched_once(self):
+        with mock.patch.object(User, 'has_perm') as has_perm:
+            with mock.patch.object(User, 'get_all_permissions', return_value={'test_app.foo'}) as get_all:
+                output = self.render()
+
+        self.assertEqual(get_all.call_count, 1)
+        self.assertEqual(has_perm.call_count, 0)
+        self.assertIn('/foo', output)
+        self.assertIn('/any', output)
+        self.assertNotIn('/all', output)
+        self.assertNotIn('/bar', output)
+
+    def test_batched_permissions_match_has_perm(self):
+        expected = self.render()
+        with mock.patch.dict(navutils_tags.settings.NAVUTILS_MENU_CONFIG, {'BATCH_PERMISSIONS': False}):
+            self.assertEqual(self.render(), expected)
+
+    def test_superuser_has_all_permissions(self):
+        self.user.is_superuser = True
+
+        with mock.patch.object(User, 'has_perm') as has_perm:
+            output = self.render()
+
+        self.assertEqual(has_perm.call_count, 0)
+        self.assertIn('/all', output)
+        self.assertIn('/bar', output)
+
+    @override_settings(AUTHENTICATION_BACKENDS=[
+        'django.contrib.auth.backends.ModelBackend',
+        'tests.test_permissions.CustomBackend',
+    ])
+    def test_fallback_to_has_perm_for_custom_backends(self):
+        self.assertIsNone(permissions.get_all_permissions(self.user))
+
+        output = self.render()
+        self.assertIn('/all', output)
+        self.assertIn('/bar', output)
+
+    @override_settings(AUTHENTICATION_BACKENDS=['tests.test_permissions.OptOutBackend'])
+    def test_backends_can_opt_out(self):
+        self.assertIsNone(permissions.get_all_permissions(self.user))
+
+    def test_nodes_can_opt_out(self):
+        class ObjectPermissionNode(menu.PermissionNode):
+            batch_permissions = False
+
+        self.menu.register(ObjectPermissionNode('object', 'Object', url='/object', permission='test_app.foo'))
+
+        with mock.patch.object(User, 'has_perm', return_value=True) as has_perm:
+            self.render()
+
+        self.assertTrue(has_perm.called)
+        for call in has_perm.call_args_list:
+            self.assertEqual(call, mock.call('test_app.foo'))
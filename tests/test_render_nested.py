@@ -1,6 +1,12 @@
+from pathlib import Path
+from unittest import mock
+
+from django.conf import settings
 from django.test import TestCase
 from django.template import Context
+from django.utils.autoreload import file_changed
 
+from navutils.cache import LRUCache
 from navutils.templatetags import navutils_tags
 
 
@@ -21,3 +27,62 @@ class RenderNestedTest(TestCase):
         self.assertEqual(
             output,
             '1 // 2 // 3')
+
+    def test_render_nested_plain_text_skips_template_engine(self):
+        navutils_tags.nested_templates.clear()
+
+        output = navutils_tags.render_nested(Context({}), 'Plain <b>label</b>')
+        self.assertEqual(output, 'Plain <b>label</b>')
+        self.assertEqual(len(navutils_tags.nested_templates), 0)
+
+    def test_render_nested_reuses_compiled_templates(self):
+        navutils_tags.nested_templates.clear()
+        block = '{{ value }}'
+
+        self.assertEqual(navutils_tags.render_nested(Context({'value': 1}), block), '1')
+        self.assertEqual(navutils_tags.render_nested(Context({'value': 2}), block), '2')
+
+        info = navutils_tags.nested_templates.info()
+        self.assertEqual(info['misses'], 1)
+        self.assertEqual(info['hits'], 1)
+        self.assertEqual(info['size'], 1)
+
+
+class ResolvedTemplatesTest(TestCase):
+
+    def setUp(self):
+        navutils_tags.clear_resolved_templates()
+
+    def test_templates_are_loaded_once(self):
+        with mock.patch.object(navutils_tags, 'load_template', wraps=navutils_tags.load_template) as load:
+            first = navutils_tags.get_template('navutils/node.html')
+            second = navutils_tags.get_template('navutils/node.html')
+            navutils_tags.get_template('navutils/menu.html')
+
+        self.assertIs(first, second)
+        self.assertEqual(load.call_count, 2)
+
+    def test_templates_are_dropped_when_settings_change(self):
+        navutils_tags.get_template('navutils/node.html')
+        with self.settings(TEMPLATES=settings.TEMPLATES):
+            self.assertEqual(navutils_tags.resolved_templates, {})
+
+    def test_templates_are_dropped_when_files_change(self):
+        navutils_tags.get_template('navutils/node.html')
+        file_changed.send(sender=None, file_path=Path('navutils/node.html'))
+
+        self.assertEqual(navutils_tags.resolved_templates, {})
+
+
+class LRUCacheTest(TestCase):
+
+    def test_evicts_least_recently_used_entries(self):
+        cache = LRUCache(maxsize=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+
+        self.assertIn('a', cache)
+        self.assertNotIn('b', cache)
+        self.assertIn('c', cache)
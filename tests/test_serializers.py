@@ -0,0 +1,112 @@
+import json
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import AnonymousUser
+from django.http import Http404
+from django.test import RequestFactory, TestCase
+
+from navutils import menu
+from navutils.serializers import MenuSerializer, serialize_menu
+from navutils.views import MenuJSONView
+
+User = get_user_model()
+
+
+class SerializerTest(TestCase):
+
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.user = User.objects.create(username='user')
+        self.staff_member = User.objects.create(username='staff', is_staff=True)
+
+        self.menu = menu.Menu('main', css_class='navbar')
+        self.menu.register(menu.Node('blog', 'Blog', url='/blog', weight=5, children=[
+            menu.Node('category', 'Category', pattern_name='blog', css_class='{{ user.username }}'),
+            menu.StaffNode('admin', 'Admin', url='/blog/admin', children=[
+                menu.Node('posts', 'Posts', url='/blog/admin/posts'),
+            ]),
+        ]))
+        self.menu.register(menu.Node('index', 'Index', pattern_name='index', attrs={'data-id': '{{ node.id }}'},
+                                     link_attrs={'target': '_blank'}))
+        self.menu.register(menu.Node('divider', 'Other', divider=True, weight=-1))
+
+    def test_serialize_menu(self):
+        data = serialize_menu(self.menu, self.user)
+
+        self.assertEqual(data, {
+            'id': 'main',
+            'css_class': 'navbar',
+            'nodes': [
+                {'id': 'blog', 'label': 'Blog', 'url': '/blog', 'children': [
+                    {'id': 'blog:category', 'label': 'Category', 'url': '/blog', 'css_class': 'user'},
+                ]},
+                {'id': 'index', 'label': 'Index', 'url': '/', 'attrs': {'data-id': 'index'},
+                 'link_attrs': {'target': '_blank'}},
+                {'id': 'divider', 'label': 'Other', 'divider': True},
+            ],
+        })
+
+    def test_serialize_menu_max_depth(self):
+        data = serialize_menu(self.menu, self.staff_member)
+        self.assertEqual(data['nodes'][0]['children'][1]['children'][0]['id'], 'blog:admin:posts')
+
+        data = serialize_menu(self.menu, self.staff_member, max_depth=1)
+        self.assertNotIn('children', data['nodes'][0]['children'][1])
+
+    def test_etag_depends_on_visibility(self):
+        def get_etag(user):
+            return MenuSerializer({}, user).get_etag(self.menu)
+
+        self.assertEqual(get_etag(self.user), get_etag(User(username='other')))
+        self.assertNotEqual(get_etag(self.user), get_etag(self.staff_member))
+
+    def test_etag_depends_on_structure(self):
+        etag = MenuSerializer({}, self.user).get_etag(self.menu)
+        self.menu['blog'].add(menu.Node('new', 'New', url='/new'))
+        self.assertNotEqual(MenuSerializer({}, self.user).get_etag(self.menu), etag)
+
+    def test_etag_depends_on_dynamic_children(self):
+        labels = ['First']
+        self.menu.register(menu.Node('dynamic', 'Dynamic', url='/dynamic', children=lambda: [
+            menu.Node('generated', labels[0], url='/generated'),
+        ]))
+        etag = MenuSerializer({}, self.user).get_etag(self.menu)
+        self.assertEqual(MenuSerializer({}, self.user).get_etag(self.menu), etag)
+
+        labels[0] = 'Second'
+        self.assertNotEqual(MenuSerializer({}, self.user).get_etag(self.menu), etag)
+
+    def test_view(self):
+        request = self.factory.get('/menu.json')
+        request.user = AnonymousUser()
+        response = MenuJSONView.as_view(menu=self.menu)(request)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content.decode('utf-8'))['nodes'][0]['id'], 'blog')
+        self.assertIn('private', response['Cache-Control'])
+        self.assertIn('no-cache', response['Cache-Control'])
+        self.assertIn('Cookie', response['Vary'])
+
+        request = self.factory.get('/menu.json', HTTP_IF_NONE_MATCH=response['ETag'])
+        request.user = AnonymousUser()
+        not_modified = MenuJSONView.as_view(menu=self.menu)(request)
+
+        self.assertEqual(not_modified.status_code, 304)
+        self.assertEqual(not_modified.content, b'')
+        self.assertEqual(not_modified['ETag'], response['ETag'])
+
+        request = self.factory.get('/menu.json', HTTP_IF_NONE_MATCH=response['ETag'])
+        request.user = self.staff_member
+        self.assertEqual(MenuJSONView.as_view(menu=self.menu)(request).status_code, 200)
+
+    def test_view_looks_up_menu_id(self):
+        menu.registry.register(self.menu)
+        self.addCleanup(menu.registry.pop, 'main')
+        request = self.factory.get('/menu.json')
+        request.user = self.user
+
+        response = MenuJSONView.as_view()(request, menu_id='main')
+        self.assertEqual(json.loads(response.content.decode('utf-8'))['id'], 'main')
+
+        with self.assertRaises(Http404):
+            MenuJSONView.as_view()(request, menu_id='missing')